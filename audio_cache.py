@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from os import makedirs
+from os.path import exists, join
+
+import numpy as np
+from pydub import AudioSegment
+
+import instrumentation
+from envelope import LoudnessEnvelope, samples_of
+
+log = logging.getLogger(__name__)
+
+
+class AudioCache:
+    """
+    On-disk cache of decoded audio and its loudness envelope, so repeat runs over the same input files
+    don't have to go through ffmpeg again.
+
+    Entries are keyed by a hash of the input file's contents plus the decode parameters, and stored as
+    .npy files. Envelopes are memory-mapped when read back, audio is read in whole since an AudioSegment
+    has to hold its own bytes. Once the cache grows past max_bytes, the least recently used entries are
+    removed.
+
+    Several processes can share a cache directory (--jobs, batch runs). Any of them may evict an entry
+    another is about to read, which is then just a cache miss.
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not exists(cache_dir):
+            makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, format="mp3", parameters=None):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        digest.update(json.dumps({"format": format, "parameters": parameters}, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _path(self, key, suffix):
+        return join(self.cache_dir, "{}.{}".format(key, suffix))
+
+    def _touch(self, key):
+        # file modification times double as the last-used time for eviction
+        for suffix in ("json", "pcm.npy", "envelope.npy"):
+            try:
+                os.utime(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _tmp_path(self, path):
+        # unique to whoever is writing, two processes saving the same entry mustn't write into one file
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=self.cache_dir)
+        os.close(fd)
+        return tmp_path
+
+    def _save(self, path, array):
+        tmp_path = self._tmp_path(path)
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+    def _save_meta(self, path, meta):
+        # like the arrays, never seen half written
+        tmp_path = self._tmp_path(path)
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def load_audio(self, path, format="mp3", parameters=None, key=None):
+        key = key or self.key(path, format, parameters)
+        meta_path = self._path(key, "json")
+        pcm_path = self._path(key, "pcm.npy")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            # one copy, straight from the file into the AudioSegment's bytes
+            samples = np.load(pcm_path, mmap_mode="r")
+            audio_segment = AudioSegment(samples.tobytes(), sample_width=meta["sample_width"],
+                                         frame_rate=meta["frame_rate"], channels=meta["channels"])
+        except FileNotFoundError:
+            # never cached, or evicted, perhaps by another process part way through
+            pass
+        else:
+            self._touch(key)
+            instrumentation.count("audio_cache_hits")
+            log.info("Loaded decoded audio for %s from cache", path)
+            return audio_segment
+
+        instrumentation.count("audio_cache_misses")
+        log.info("Decoding %s", path)
+        # pydub runs ffprobe for the format, then ffmpeg to decode
+        instrumentation.count("ffmpeg_processes", 2)
+        audio_segment = AudioSegment.from_file(path, format=format, parameters=parameters)
+        self._save(pcm_path, samples_of(audio_segment))
+        # the audio is saved first, an entry only counts once its meta is there
+        self._save_meta(meta_path, {"source": path, "sample_width": audio_segment.sample_width,
+                                    "frame_rate": audio_segment.frame_rate, "channels": audio_segment.channels})
+        self.evict()
+        return audio_segment
+
+    def load_envelope(self, path, audio_segment, format="mp3", parameters=None, key=None):
+        key = key or self.key(path, format, parameters)
+        envelope_path = self._path(key, "envelope.npy")
+        try:
+            cumulative_energy = np.load(envelope_path, mmap_mode="r")
+        except FileNotFoundError:
+            pass
+        else:
+            self._touch(key)
+            return LoudnessEnvelope(cumulative_energy, len(audio_segment), audio_segment.frame_rate,
+                                    audio_segment.channels, audio_segment.sample_width)
+
+        envelope = LoudnessEnvelope.from_segment(audio_segment)
+        self._save(envelope_path, envelope.cumulative_energy)
+        self.evict()
+        return envelope
+
+    def load(self, path, format="mp3", parameters=None):
+        """Decoded audio and loudness envelope for the file at path, hashing its contents just once."""
+        key = self.key(path, format, parameters)
+        audio_segment = self.load_audio(path, format, parameters, key=key)
+        return audio_segment, self.load_envelope(path, audio_segment, format, parameters, key=key)
+
+    def evict(self):
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue
+            key = name.split(".")[0]
+            try:
+                stat = os.stat(join(self.cache_dir, name))
+            except FileNotFoundError:
+                # evicted by another process since the listing
+                continue
+            size, last_used = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+
+        total = sum(size for size, _ in entries.values())
+        for key, (size, _) in sorted(entries.items(), key=lambda entry: entry[1][1]):
+            if total <= self.max_bytes:
+                break
+            log.info("Evicting %s from audio cache", key)
+            # the meta goes first, so the entry stops being found before its audio does
+            for suffix in ("json", "pcm.npy", "envelope.npy"):
+                try:
+                    os.remove(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+            total -= size
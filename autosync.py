@@ -0,0 +1,165 @@
+import numpy as np
+
+from envelope import LoudnessEnvelope
+
+# resolution of the loudness measurements used to find where a chunk's speech starts and ends
+_FEATURE_WINDOW_MS = 10
+
+
+def chunk_features(segment, silence_thresh=-37, contour_points=8):
+    """
+    Cheap description of one chunk: its duration, the silence before and after the speech in it, and how its
+    energy is spread over contour_points equal slices of it.
+    """
+    envelope = LoudnessEnvelope.from_segment(segment)
+    loud = np.flatnonzero(envelope.window_rms(_FEATURE_WINDOW_MS) > envelope.silence_thresh_amplitude(silence_thresh))
+    if len(loud):
+        leading_silence = loud[0]
+        trailing_silence = envelope.length_ms - (loud[-1] + _FEATURE_WINDOW_MS)
+    else:
+        leading_silence = trailing_silence = envelope.length_ms
+
+    bounds = np.linspace(0, envelope.length_ms, contour_points + 1).astype(int)
+    energy = np.diff(envelope.cumulative_energy[bounds]).astype(np.float64)
+    contour = energy / energy.sum() if energy.sum() else energy
+    return np.concatenate(([segment.duration_seconds, leading_silence / 1000.0, trailing_silence / 1000.0], contour))
+
+
+def track_features(lang_chunks, default_silence_thresh=-37):
+    return np.array([chunk_features(chunk.segment, chunk.silence_thresh if chunk.silence_thresh is not None
+                                    else default_silence_thresh)
+                     for chunk in lang_chunks])
+
+
+def _relative(features):
+    # duration and the pauses either side as log ratios to the track's median, so a slower reader's chunks
+    # still look like the faster reader's
+    logs = np.log(features[:, :3] + 0.05)
+    return logs - np.median(logs, axis=0)
+
+
+def banded_dtw(cost, n, m, band):
+    """
+    Dynamic time warping between sequences of length n and m, only considering pairs (i, j) within band of
+    the diagonal, so it takes O(n * band) rather than O(n * m). cost(i, js) gives the cost of pairing i with
+    each of js. Returns the lowest cost path as a list of (i, j).
+    """
+    centers = np.round(np.arange(n) * ((m - 1) / max(n - 1, 1))).astype(int)
+    lows = np.clip(centers - band, 0, m - 1)
+    highs = np.clip(centers + band, 0, m - 1)
+    # widen the band where it jumps ahead faster than a diagonal step, so there's always a way through
+    highs = np.maximum(highs, np.concatenate((lows[1:] - 1, [m - 1])))
+
+    total = []
+    came_from = []
+    for i in range(n):
+        js = np.arange(lows[i], highs[i] + 1)
+        row_cost = cost(i, js)
+        row_total = np.full(len(js), np.inf)
+        row_from = np.zeros(len(js), dtype=int)
+        if i > 0:
+            prev_low, prev_total = lows[i - 1], total[i - 1]
+            in_prev = (js >= prev_low) & (js <= highs[i - 1])
+            # stay on the same j (vertical step)
+            row_total[in_prev] = prev_total[js[in_prev] - prev_low]
+            # or come diagonally from j - 1
+            diagonal = (js - 1 >= prev_low) & (js - 1 <= highs[i - 1])
+            diagonal_total = np.full(len(js), np.inf)
+            diagonal_total[diagonal] = prev_total[js[diagonal] - 1 - prev_low]
+            row_from = np.where(diagonal_total < row_total, 1, 0)
+            row_total = np.minimum(row_total, diagonal_total)
+        elif len(js):
+            row_total[0] = 0
+        # horizontal steps within the row have to be done in order
+        for k in range(len(js)):
+            if k > 0 and row_total[k - 1] < row_total[k]:
+                row_total[k] = row_total[k - 1]
+                row_from[k] = 2
+            row_total[k] += row_cost[k]
+        total.append(row_total)
+        came_from.append(row_from)
+
+    path = []
+    i, j = n - 1, m - 1
+    while i >= 0:
+        path.append((i, j))
+        step = came_from[i][j - lows[i]]
+        if i == 0 and j == 0:
+            break
+        if i == 0:
+            j -= 1
+        elif step == 0:
+            i -= 1
+        elif step == 1:
+            i, j = i - 1, j - 1
+        else:
+            j -= 1
+    return path[::-1]
+
+
+def timing_band(base_starts, tgt_starts, slack=10):
+    """
+    Band for banded_dtw from where the chunks fall in time: the furthest the target chunk playing at the start
+    of any base chunk is from the diagonal, plus slack chunks either side. It grows with how unevenly the two
+    tracks are split, not with how many chunks they have.
+    """
+    n, m = len(base_starts), len(tgt_starts)
+    centers = np.arange(n) * ((m - 1) / max(n - 1, 1))
+    by_timing = np.clip(np.searchsorted(tgt_starts, base_starts, side="right") - 1, 0, m - 1)
+    return int(np.ceil(np.abs(by_timing - centers).max())) + slack
+
+
+def find_sync_points(base_features, tgt_features, band=None, spacing=10):
+    """
+    Aligns the chunks of the two tracks by their features and picks sync points from the alignment, about one
+    every spacing base chunks. Sync points are returned in the "<base_chunk_index>:<tgt_chunk_index>" format
+    used by --sync-points.
+    """
+    n, m = len(base_features), len(tgt_features)
+    if n < 2 or m < 2:
+        return []
+
+    # chunks are matched on what they're like compared to the rest of their track. where they are in it is
+    # only a weak hint, so a few chunks one track has and the other doesn't (an intro, an outro) don't pull
+    # every match after them out of line
+    base_durations, tgt_durations = base_features[:, 0], tgt_features[:, 0]
+    base_ends = np.cumsum(base_durations) / base_durations.sum()
+    tgt_ends = np.cumsum(tgt_durations) / tgt_durations.sum()
+    base_starts, tgt_starts = base_ends - base_durations / base_durations.sum(), tgt_ends - tgt_durations / tgt_durations.sum()
+    base_relative, tgt_relative = _relative(base_features), _relative(tgt_features)
+    if band is None:
+        band = timing_band(base_starts, tgt_starts)
+
+    def cost(i, js):
+        duration = np.abs(base_relative[i, 0] - tgt_relative[js, 0])
+        pauses = np.abs(base_relative[i, 1:] - tgt_relative[js, 1:]).mean(axis=1)
+        contour = np.abs(base_features[i, 3:] - tgt_features[js, 3:]).sum(axis=1)
+        position = np.abs(base_starts[i] - tgt_starts[js])
+        return duration + pauses * 0.3 + contour * 0.5 + position
+
+    def run_cost(run, shift=0):
+        return sum(cost(i, np.array([j + shift]))[0] for i, j in run)
+
+    path = banded_dtw(cost, n, m, band)
+    on_path = set(path)
+
+    # a good place to sync is in the middle of a few chunks matched one to one, that match each other clearly
+    # better than they would one or two chunks either way
+    candidates = []
+    for i, j in path:
+        run = [(i + k, j + k) for k in range(-1, 3)]
+        if not (0 < i < n - 1 and 0 < j < m - 1) or not all(step in on_path for step in run):
+            continue
+        matched = run_cost(run)
+        shifted = [run_cost(run, shift) for shift in (-2, -1, 1, 2)
+                   if 0 <= run[0][1] + shift and run[-1][1] + shift < m]
+        if shifted and matched < 0.7 * min(shifted):
+            candidates.append((matched, i, j))
+
+    sync_points = []
+    for window_start in range(0, n, spacing):
+        in_window = [c for c in candidates if window_start <= c[1] < window_start + spacing]
+        if in_window:
+            _, i, j = min(in_window)
+            sync_points.append("{}:{}".format(i, j))
+    return sync_points
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import exists
+
+import instrumentation
+import interleave
+from audio_cache import AudioCache
+
+log = logging.getLogger(__name__)
+
+# manifest fields that are passed straight through to interleave.interleave_chapter
+CHAPTER_SETTINGS = ["chunkdir", "base_offset", "target_offset", "base_audio_silence_threshold",
+                    "target_audio_silence_threshold", "sync_points", "threshold_search", "streaming",
+                    "chunk_format", "export_jobs", "auto_sync", "reencode_all", "dry_run"]
+
+
+def load_manifest(manifest_path):
+    """
+    A manifest is a JSON file listing the chapter pairs of a book, e.g.:
+
+    {
+      "outdir": "out/the-little-prince",
+      "chunkdir": "chunks/the-little-prince",
+      "chapters": [
+        {"title": "chapter-1", "base_audio": "the-little-prince/chapter-1.mp3",
+         "target_audio": "el-principito/capitulo-1.mp3", "target_offset": 1, "sync_points": ["4:16"]},
+        ...
+      ]
+    }
+
+    Top level settings apply to every chapter unless the chapter sets its own. Each chapter is written
+    to <outdir>/<title> unless it gives an outdir.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    defaults = {key: value for key, value in manifest.items() if key != "chapters"}
+    chapters = []
+    for chapter_settings in manifest["chapters"]:
+        chapter = dict(defaults, **chapter_settings)
+        if "outdir" not in chapter_settings:
+            chapter["outdir"] = "{}/{}".format(defaults.get("outdir", "."), chapter["title"])
+        chapters.append(chapter)
+    return chapters
+
+
+def load_progress(progress_path):
+    if not exists(progress_path):
+        return {}
+    with open(progress_path) as f:
+        return json.load(f)
+
+
+def save_progress(progress_path, progress):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(tmp_path, progress_path)
+
+
+def run_chapter(chapter, cache_dir=None, cache_size_mb=4096):
+    # runs in a worker process, only send back the numbers - not the audio
+    cache = AudioCache(cache_dir, max_bytes=cache_size_mb * 1024 * 1024) if cache_dir is not None else None
+    settings = {key: chapter[key] for key in CHAPTER_SETTINGS if key in chapter}
+    start = time.time()
+    lang_chunks, profile = instrumentation.run_profiled(
+        interleave.interleave_chapter, chapter["base_audio"], chapter["target_audio"], chapter["title"],
+        chapter["outdir"], cache=cache, **settings)
+    return {"audio_seconds": sum(chunk.duration_seconds for chunk in lang_chunks),
+            "wall_seconds": time.time() - start, "profile": profile}
+
+
+def run_batch(chapters, progress_path, workers=None, cache_dir=None, cache_size_mb=4096):
+    progress = load_progress(progress_path)
+    # a chapter counts as done only if it was finished with the same settings it has now
+    pending = [chapter for chapter in chapters
+               if progress.get(chapter["title"], {}).get("chapter") != chapter]
+    log.info("%s of %s chapters already done, %s to go", len(chapters) - len(pending), len(chapters), len(pending))
+
+    start = time.time()
+    audio_seconds = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(run_chapter, chapter, cache_dir, cache_size_mb): chapter for chapter in pending}
+        for future in as_completed(futures):
+            chapter = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                log.error("Chapter %s failed: %s", chapter["title"], e)
+                failed.append(chapter["title"])
+                continue
+            audio_seconds += result["audio_seconds"]
+            # every chapter's stages add up into this process's profile
+            instrumentation.profile.merge(result.pop("profile"))
+            # recorded as soon as each chapter finishes, so an interrupted batch picks up from here
+            progress[chapter["title"]] = dict(result, chapter=chapter)
+            save_progress(progress_path, progress)
+            log.info("Finished chapter %s: %.1f min of audio in %.1f sec",
+                     chapter["title"], result["audio_seconds"] / 60, result["wall_seconds"])
+
+    wall_seconds = time.time() - start
+    if wall_seconds > 0 and audio_seconds > 0:
+        log.info("Processed %.2f audio hours in %.1f sec, %.1f audio hours per wall-clock hour",
+                 audio_seconds / 3600, wall_seconds, audio_seconds / wall_seconds)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Interleave every chapter pair listed in a manifest, in parallel')
+    parser.add_argument('manifest', type=str,
+                        help='JSON file listing the chapter pairs to interleave and their settings')
+    parser.add_argument('--progress', type=str,
+                        help='File recording which chapters are finished, so an interrupted batch can be resumed. '
+                             'Defaults to <manifest>.progress.json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of chapters to work on at the same time')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to keep decoded audio in, so later runs over the same audio files skip decoding')
+    parser.add_argument('--cache-size-mb', type=int, default=4096,
+                        help='Size the audio cache is kept under, least recently used files are removed first')
+    parser.add_argument('--profile', type=str,
+                        help='Write the time spent in each stage, summed over all chapters, to this json file')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much detail to log')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    progress_path = args.progress or "{}.progress.json".format(args.manifest)
+    failed = run_batch(load_manifest(args.manifest), progress_path, workers=args.workers,
+                       cache_dir=args.cache_dir, cache_size_mb=args.cache_size_mb)
+    if args.profile is not None:
+        instrumentation.profile.write(args.profile)
+    if failed:
+        log.error("Failed chapters: %s", ", ".join(failed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import exists
+
+from pydub import AudioSegment
+
+import interleave
+from envelope import LoudnessEnvelope, samples_of
+from fixtures import synthetic_pair
+from streaming import StreamingSplitter
+
+STAGES = ["decode_wav", "decode_mp3", "envelope", "chunk_step", "chunk_index", "chunk_streaming", "plan",
+          "assemble", "export"]
+
+
+def _rss_mb():
+    # current resident set size, linux only
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        return None
+
+
+def _peak_rss_mb():
+    # the high-water mark of rss, since it was last reset on linux (VmHWM), since the process started elsewhere
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    """
+    Starts measuring peak memory afresh, so making the fixtures doesn't count towards a stage's peak. Returns
+    the level later peaks are measured from: linux can reset the high-water mark to the current rss, elsewhere
+    only the increase over the peak so far can be seen.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _rss_mb()
+    except OSError:
+        return _peak_rss_mb()
+
+
+def _chunks(track, lang_title):
+    audio, _ = track
+    return interleave.create_audio_chunks(audio, 5, 15, lang_title, threshold_search="index")
+
+
+def _prepare(stage, base, target, tmpdir):
+    # everything a stage needs that isn't part of what's being timed
+    if stage in ("decode_wav", "decode_mp3"):
+        path = os.path.join(tmpdir, "base." + stage[-3:])
+        base[0].export(path, format=stage[-3:])
+        return path
+    if stage in ("plan", "assemble", "export"):
+        base_chunks, target_chunks = _chunks(base, "English"), _chunks(target, "Spanish")
+        if stage == "plan":
+            return base_chunks, target_chunks
+        return interleave.interleave_matching_audio_segments(base_chunks, target_chunks)
+    return base[0]
+
+
+def _run(stage, prepared, tmpdir):
+    if stage == "decode_wav":
+        return AudioSegment.from_wav(prepared)
+    if stage == "decode_mp3":
+        return AudioSegment.from_mp3(prepared)
+    if stage == "envelope":
+        return LoudnessEnvelope.from_segment(prepared)
+    if stage == "chunk_step":
+        return interleave.create_audio_chunks(prepared, 5, 15, "English", threshold_search="step")
+    if stage == "chunk_index":
+        return interleave.create_audio_chunks(prepared, 5, 15, "English", threshold_search="index")
+    if stage == "chunk_streaming":
+        splitter = StreamingSplitter(prepared.frame_rate, prepared.channels, min_silence_len=900,
+                                     silence_thresh=-37, keep_silence=900)
+        samples = samples_of(prepared)
+        block = prepared.frame_rate * prepared.channels * 10
+        chunks = []
+        for start in range(0, len(samples), block):
+            chunks += splitter.feed(samples[start:start + block])
+        return chunks + splitter.finish()
+    if stage == "plan":
+        base_chunks, target_chunks = prepared
+        return interleave.plan_interleave([c.duration_seconds for c in base_chunks],
+                                          [c.duration_seconds for c in target_chunks])
+    if stage == "assemble":
+        return interleave.assemble_audio((chunk.segment for chunk in prepared), trailing_silence_ms=3000)
+    if stage == "export":
+        return interleave.export_each_audio_chunk(prepared, tmpdir, "bench", "EN", "ES", jobs=os.cpu_count())
+    raise ValueError("Unknown stage {}".format(stage))
+
+
+def measure(stage, minutes, seed=0):
+    """Times one stage on a synthetic pair of tracks minutes long. Meant to run in a fresh process."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        base, target = synthetic_pair(minutes * 60, seed=seed)
+        prepared = _prepare(stage, base, target, tmpdir)
+        del base, target
+        rss_before = _rss_mb()
+        peak_from = _reset_peak_rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        _run(stage, prepared, tmpdir)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        peak_rss = _peak_rss_mb()
+    # what the stage itself took on top of its inputs, at its peak
+    return {"stage": stage, "minutes": minutes, "wall_seconds": wall, "cpu_seconds": cpu,
+            "rss_before_mb": rss_before, "peak_rss_mb": max(0.0, peak_rss - peak_from)}
+
+
+def run_benchmarks(stages, lengths, seed=0):
+    results = []
+    for minutes in lengths:
+        for stage in stages:
+            # a new process for every measurement, so nothing is left over from the one before
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(measure, stage, minutes, seed).result()
+            results.append(result)
+            print("{:>16} {:>6} min  {:>9.3f} s wall  {:>9.3f} s cpu  {:>8.1f} MB peak rss over inputs".format(
+                stage, minutes, result["wall_seconds"], result["cpu_seconds"], result["peak_rss_mb"]))
+    return results
+
+
+def compare(results, baseline):
+    baseline = {(r["stage"], r["minutes"]): r for r in baseline}
+    print("Compared to baseline:")
+    for result in results:
+        before = baseline.get((result["stage"], result["minutes"]))
+        if before is None or not before["wall_seconds"] or not before["peak_rss_mb"]:
+            continue
+        print("{:>16} {:>6} min  {:>6.2f}x wall time  {:>6.2f}x peak rss".format(
+            result["stage"], result["minutes"], result["wall_seconds"] / before["wall_seconds"],
+            result["peak_rss_mb"] / before["peak_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each stage of the pipeline on synthetic audio')
+    parser.add_argument('--stages', type=str, nargs='+', choices=STAGES,
+                        help='Stages to benchmark, defaults to all of them (mp3 stages need ffmpeg)')
+    parser.add_argument('--lengths', type=float, nargs='+', default=[1, 10, 60, 120],
+                        help='Lengths of synthetic audio to benchmark with, in minutes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for generating the synthetic audio')
+    parser.add_argument('--baseline', type=str, default='bench_baseline.json',
+                        help='File of earlier results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save these results as the new baseline')
+    args = parser.parse_args()
+
+    stages = args.stages or STAGES
+    if shutil.which(AudioSegment.converter) is None:
+        skipped = [stage for stage in stages if stage in ("decode_mp3", "export")]
+        if skipped:
+            print("No ffmpeg found, skipping {}".format(", ".join(skipped)))
+        stages = [stage for stage in stages if stage not in skipped]
+
+    results = run_benchmarks(stages, args.lengths, seed=args.seed)
+    if exists(args.baseline):
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to {}".format(args.baseline))
+
+if __name__ == '__main__':
+    main()
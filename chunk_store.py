@@ -0,0 +1,115 @@
+import json
+import os
+from os.path import exists
+
+import numpy as np
+from pydub import AudioSegment
+
+
+def store_paths(store_dir, title):
+    return "{}/{}.pcm".format(store_dir, title), "{}/{}.json".format(store_dir, title)
+
+
+class ChunkStoreWriter:
+    """
+    Writes a chunk store a chunk at a time, so the chunks never all have to be in memory at once. Nothing
+    counts as written until close(), use it as a context manager to have that happen on success only.
+    """
+
+    def __init__(self, store_dir, title, silence_thresh=None):
+        self.pcm_path, self.index_path = store_paths(store_dir, title)
+        self.index = {"sample_width": None, "frame_rate": None, "channels": None,
+                      "silence_thresh": silence_thresh, "chunks": []}
+        self._offset = 0
+        self._file = open(self.pcm_path + ".tmp", "wb")
+
+    def add(self, segment, src_idx):
+        index = self.index
+        params = (segment.sample_width, segment.frame_rate, segment.channels)
+        if index["chunks"] and params != (index["sample_width"], index["frame_rate"], index["channels"]):
+            raise ValueError("All chunks in a chunk store must have the same audio format")
+        index["sample_width"], index["frame_rate"], index["channels"] = params
+        self._file.write(segment.raw_data)
+        index["chunks"].append({"src_idx": src_idx, "offset": self._offset, "length": len(segment.raw_data),
+                                "duration_seconds": segment.duration_seconds})
+        self._offset += len(segment.raw_data)
+
+    def close(self):
+        self._file.close()
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        # a store only counts as being there once its index is, so the old index goes before the audio is
+        # replaced and the new one comes last. a crash part way through leaves no store, never an index
+        # that doesn't go with the audio next to it
+        if exists(self.index_path):
+            os.remove(self.index_path)
+        os.replace(self.pcm_path + ".tmp", self.pcm_path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.pcm_path + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_chunk_store(segments, store_dir, title, src_idxs=None, silence_thresh=None):
+    """
+    Writes the raw audio of every segment, one after the other, into a single <title>.pcm file next to a
+    <title>.json index of where each one starts, how long it is and which chunk of the source it was.
+    All segments need to have the same sample width, frame rate and channels.
+    """
+    if src_idxs is None:
+        src_idxs = list(range(len(segments)))
+    with ChunkStoreWriter(store_dir, title, silence_thresh=silence_thresh) as writer:
+        for segment, src_idx in zip(segments, src_idxs):
+            writer.add(segment, src_idx)
+
+
+class ChunkStore:
+    """
+    A chunk store opened for reading. The audio is memory-mapped, so opening one is quick no matter how
+    many chunks it has, and only the chunks that are actually used get read in.
+    """
+
+    def __init__(self, store_dir, title):
+        self.store_dir = store_dir
+        self.title = title
+        pcm_path, index_path = store_paths(store_dir, title)
+        with open(index_path) as f:
+            index = json.load(f)
+        self.sample_width = index["sample_width"]
+        self.frame_rate = index["frame_rate"]
+        self.channels = index["channels"]
+        self.silence_thresh = index["silence_thresh"]
+        self.chunks = index["chunks"]
+        # an empty file can't be memory-mapped
+        self._data = np.memmap(pcm_path, dtype=np.uint8, mode="r") if os.path.getsize(pcm_path) else np.zeros(0, np.uint8)
+
+    def __reduce__(self):
+        # sent to other processes by where it is, rather than by the audio in it
+        return ChunkStore, (self.store_dir, self.title)
+
+    @staticmethod
+    def exists(store_dir, title):
+        return all(exists(path) for path in store_paths(store_dir, title))
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def raw_data(self, i):
+        """A view of the i'th chunk's raw audio in the memory-mapped file, nothing is copied"""
+        chunk = self.chunks[i]
+        return self._data[chunk["offset"]:chunk["offset"] + chunk["length"]]
+
+    def segment(self, i):
+        # AudioSegment needs bytes, so this is where the chunk's audio is read in and copied
+        return AudioSegment(self.raw_data(i).tobytes(), sample_width=self.sample_width,
+                            frame_rate=self.frame_rate, channels=self.channels)
@@ -1,5 +1,9 @@
-from pydub import AudioSegment
+#!/usr/bin/env python3
+import sys
 
-# gcloud speech api doesn't handle mp3s
-song = AudioSegment.from_mp3("C:\\Users\\ben\\Documents\\code\\interleaved-test\\el-principito-capitulo-1.mp3")
-song.export("C:\\Users\\ben\\Documents\\code\\interleaved-test\\el-principito-capitulo-1.flac", format="flac", parameters=["-ar", "16000", "-ac", "1"])
\ No newline at end of file
+import convert_audio
+
+# gcloud speech api doesn't handle mp3s, convert to 16kHz mono flac for it
+# takes the same arguments as convert_audio.py, e.g. convert-mp3-flac.py el-principito/
+if __name__ == '__main__':
+    sys.exit(convert_audio.main(["--format", "flac", "--frame-rate", "16000", "--channels", "1"] + sys.argv[1:]))
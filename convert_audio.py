@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os.path import exists, getmtime, isdir, join, relpath, splitext
+
+from pydub import AudioSegment
+
+import instrumentation
+
+log = logging.getLogger(__name__)
+
+
+def find_inputs(patterns, extensions=("mp3",)):
+    """
+    Files to convert, as (path, root) pairs. Patterns can be files, globs or directories, directories are
+    searched recursively for files with the given extensions. Outputs keep their path relative to root.
+    """
+    inputs = []
+    for pattern in patterns:
+        if isdir(pattern):
+            for dirpath, _, filenames in sorted(os.walk(pattern)):
+                inputs += [(join(dirpath, name), pattern) for name in sorted(filenames)
+                           if splitext(name)[1][1:].lower() in extensions]
+        else:
+            inputs += [(path, os.path.dirname(path)) for path in sorted(glob.glob(pattern)) if not isdir(path)]
+    # the same file can be matched by more than one pattern, it's only converted once
+    unique = {}
+    for path, root in inputs:
+        unique.setdefault(path, root)
+    return list(unique.items())
+
+
+def output_path(path, root, outdir, format):
+    if outdir is None:
+        return "{}.{}".format(splitext(path)[0], format)
+    return join(outdir, "{}.{}".format(splitext(relpath(path, root))[0], format))
+
+
+def conversion_key(path, settings):
+    # changes whenever the input's contents or the way it's converted do
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def is_up_to_date(path, out_path, settings, check="mtime"):
+    if not exists(out_path):
+        return False
+    if check == "mtime":
+        return getmtime(out_path) >= getmtime(path)
+    # the key of the input an output was made from is kept next to it
+    key_path = out_path + ".sha256"
+    if not exists(key_path):
+        return False
+    with open(key_path) as f:
+        return f.read().strip() == conversion_key(path, settings)
+
+
+def convert_file(path, out_path, settings):
+    # ffmpeg decodes, resamples and encodes in one go, none of the audio passes through python
+    command = [AudioSegment.converter, "-y", "-v", "error", "-i", path, "-vn"]
+    if settings.get("frame_rate"):
+        command.extend(["-ar", str(settings["frame_rate"])])
+    if settings.get("channels"):
+        command.extend(["-ac", str(settings["channels"])])
+    # written under another name first, so an interrupted conversion never looks up to date
+    command.extend(["-f", settings["format"], out_path + ".tmp"])
+    instrumentation.count("ffmpeg_processes")
+    # several run at once, none of them may read from the terminal
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg returned error code {} converting {}\n\n{}".format(
+            result.returncode, path, result.stderr.decode(errors="replace")))
+    os.replace(out_path + ".tmp", out_path)
+
+
+def convert_all(inputs, outdir=None, settings=None, check="mtime", force=False, workers=None):
+    """Converts each (path, root) that isn't up to date already, returns the paths that failed"""
+    settings = settings or {"format": "flac"}
+    start = time.time()
+    pending = []
+    sources = {}
+    for path, root in inputs:
+        out_path = output_path(path, root, outdir, settings["format"])
+        if out_path == path:
+            raise ValueError("Converting {} would overwrite it, give an --outdir".format(path))
+        # e.g. a/x.mp3 and b/x.mp3 from two globs, both kept relative to their own directory
+        if out_path in sources:
+            raise ValueError("{} and {} would both be converted to {}, give the directory they're in instead so "
+                             "their subdirectories are kept".format(sources[out_path], path, out_path))
+        sources[out_path] = path
+        if force or not is_up_to_date(path, out_path, settings, check):
+            pending.append((path, out_path))
+    log.info("%s of %s files already converted, %s to go", len(inputs) - len(pending), len(inputs), len(pending))
+
+    def convert(path, out_path):
+        out_dir = os.path.dirname(out_path)
+        if out_dir and not exists(out_dir):
+            makedirs(out_dir, exist_ok=True)
+        convert_file(path, out_path, settings)
+        if check == "hash":
+            with open(out_path + ".sha256", "w") as f:
+                f.write(conversion_key(path, settings))
+        log.debug("Converted %s to %s", path, out_path)
+
+    failed = []
+    with instrumentation.stage("convert"), ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [(path, executor.submit(convert, path, out_path)) for path, out_path in pending]
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                log.error("Failed to convert %s: %s", path, e)
+                failed.append(path)
+
+    wall_seconds = time.time() - start
+    converted = len(pending) - len(failed)
+    instrumentation.count("files_converted", converted)
+    if converted and wall_seconds > 0:
+        log.info("Converted %s files in %.1f sec, %.2f files per second", converted, wall_seconds,
+                 converted / wall_seconds)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert many audio files at once, e.g. to flac for transcription')
+    parser.add_argument('inputs', type=str, nargs='+',
+                        help='Audio files, globs or directories to convert, directories are searched recursively')
+    parser.add_argument('--outdir', type=str,
+                        help='Directory to write converted files to, keeping their path relative to the directory '
+                             'they were found in. Defaults to next to each input')
+    parser.add_argument('--extensions', type=str, nargs='+', default=['mp3'],
+                        help='Extensions of the files to convert when searching directories')
+    parser.add_argument('--format', type=str, default='flac',
+                        help='Format to convert to')
+    parser.add_argument('--frame-rate', type=int,
+                        help='Sample rate to convert to, defaults to that of the input')
+    parser.add_argument('--channels', type=int,
+                        help='Number of channels to convert to, defaults to that of the input')
+    parser.add_argument('--check', type=str, choices=['mtime', 'hash'], default='mtime',
+                        help='How to tell an output is up to date. "mtime" if it\'s newer than its input, "hash" if '
+                             'it was made from the same input contents with the same settings')
+    parser.add_argument('--force', action='store_true',
+                        help='Convert every file, even ones that are up to date')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of files to convert at the same time')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much detail to log')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    settings = {"format": args.format, "frame_rate": args.frame_rate, "channels": args.channels}
+    inputs = find_inputs(args.inputs, extensions=[extension.lower().lstrip(".") for extension in args.extensions])
+    failed = convert_all(inputs, outdir=args.outdir, settings=settings, check=args.check, force=args.force,
+                         workers=args.workers)
+    if failed:
+        log.error("Failed to convert: %s", ", ".join(failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
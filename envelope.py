@@ -0,0 +1,261 @@
+import numpy as np
+from pydub.utils import db_to_float
+
+# how many milliseconds of samples to square and sum at a time when building the envelope
+# keeps the temporary arrays to a few tens of MB, even for long chapters
+_BLOCK_MS = 60 * 1000
+
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def samples_of(audio_segment):
+    """Returns the (interleaved) samples of an AudioSegment as a numpy array, without copying."""
+    return np.frombuffer(audio_segment.raw_data, dtype=SAMPLE_DTYPES[audio_segment.sample_width])
+
+
+def ms_frame_bounds(length_ms, frame_rate, start_ms=0):
+    # same arithmetic pydub uses to turn a millisecond position into a frame index when slicing
+    return (np.arange(start_ms, length_ms + 1) * (frame_rate / 1000.0)).astype(np.int64)
+
+
+def _ms_energy(samples, frame_bounds, channels, acc_dtype):
+    # energy of each millisecond between consecutive frame bounds, samples start at frame frame_bounds[0]
+    block = samples[:(frame_bounds[-1] - frame_bounds[0]) * channels].astype(acc_dtype)
+    block *= block
+    block_cumulative = np.concatenate(([0], np.cumsum(block)))
+    return np.diff(block_cumulative[(frame_bounds - frame_bounds[0]) * channels])
+
+
+class LoudnessEnvelope:
+    """
+    Cumulative signal energy at every millisecond boundary of a piece of audio.
+
+    Built once per audio track, after which the rms / dBFS of any window can be looked up with a
+    subtraction, so silence can be searched for with any threshold and window length without
+    rescanning the samples. Results match pydub.silence (seek_step=1) exactly.
+    """
+
+    def __init__(self, cumulative_energy, length_ms, frame_rate, channels, sample_width):
+        self.cumulative_energy = cumulative_energy
+        self.length_ms = length_ms
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_bounds = ms_frame_bounds(length_ms, frame_rate)
+
+    @classmethod
+    def from_segment(cls, audio_segment):
+        return cls.from_samples(samples_of(audio_segment), audio_segment.frame_rate,
+                                audio_segment.channels, audio_segment.sample_width)
+
+    @classmethod
+    def from_samples(cls, samples, frame_rate, channels, sample_width):
+        frame_count = len(samples) // channels
+        # pydub's len() of a segment
+        length_ms = round(1000 * (frame_count / frame_rate))
+        frame_bounds = np.minimum(ms_frame_bounds(length_ms, frame_rate), frame_count)
+        # squares of 32 bit samples overflow int64 sums, audioop uses doubles for those anyway
+        acc_dtype = np.float64 if sample_width == 4 else np.int64
+
+        ms_energy = np.zeros(length_ms, dtype=acc_dtype)
+        for m0 in range(0, length_ms, _BLOCK_MS):
+            m1 = min(m0 + _BLOCK_MS, length_ms)
+            ms_energy[m0:m1] = _ms_energy(samples[frame_bounds[m0] * channels:], frame_bounds[m0:m1 + 1],
+                                          channels, acc_dtype)
+
+        return cls(np.concatenate(([0], np.cumsum(ms_energy))), length_ms, frame_rate, channels, sample_width)
+
+    @classmethod
+    def from_blocks(cls, blocks, frame_rate, channels, sample_width):
+        """
+        Same as from_samples, for samples that come a block at a time (e.g. from streaming.stream_pcm). Only
+        the energy of each millisecond is kept, not the samples, so a whole book never has to be in memory.
+        """
+        acc_dtype = np.float64 if sample_width == 4 else np.int64
+        ms_energies = []
+        # samples that aren't part of a whole millisecond yet, from frame pending_start on
+        pending, pending_start = np.zeros(0, dtype=SAMPLE_DTYPES[sample_width]), 0
+        done_ms = sample_count = 0
+        for block in blocks:
+            sample_count += len(block)
+            pending = np.concatenate((pending, block))
+            frame_count = sample_count // channels
+            # the milliseconds all of whose frames are here
+            frame_bounds = ms_frame_bounds(int(frame_count * 1000 / frame_rate) + 1, frame_rate, start_ms=done_ms)
+            frame_bounds = frame_bounds[frame_bounds <= frame_count]
+            if len(frame_bounds) > 1:
+                ms_energies.append(_ms_energy(pending, frame_bounds, channels, acc_dtype))
+                pending = pending[(frame_bounds[-1] - pending_start) * channels:]
+                pending_start, done_ms = frame_bounds[-1], done_ms + len(frame_bounds) - 1
+
+        frame_count = sample_count // channels
+        # pydub's len() of a segment
+        length_ms = round(1000 * (frame_count / frame_rate))
+        if length_ms > done_ms:
+            frame_bounds = np.minimum(ms_frame_bounds(length_ms, frame_rate, start_ms=done_ms), frame_count)
+            ms_energies.append(_ms_energy(pending, frame_bounds, channels, acc_dtype))
+        ms_energy = np.concatenate(ms_energies)[:length_ms] if ms_energies else np.zeros(0, dtype=acc_dtype)
+        return cls(np.concatenate(([0], np.cumsum(ms_energy))), length_ms, frame_rate, channels, sample_width)
+
+    @property
+    def max_possible_amplitude(self):
+        return (2 ** (self.sample_width * 8)) / 2
+
+    def window_rms(self, window_len):
+        """rms of every window_len ms slice of the audio, one per millisecond start position"""
+        if self.length_ms < window_len:
+            return np.zeros(0)
+        starts = np.arange(self.length_ms - window_len + 1)
+        energy = (self.cumulative_energy[starts + window_len] - self.cumulative_energy[starts]).astype(np.float64)
+        # slices running over the end of the data get padded with silence by pydub, so these count towards the mean
+        sample_count = (self.frame_bounds[starts + window_len] - self.frame_bounds[starts]) * self.channels
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rms = np.floor(np.sqrt(energy / sample_count))
+        rms[sample_count == 0] = 0
+        return rms
+
+    def window_dbfs(self, window_len):
+        with np.errstate(divide='ignore'):
+            return 20 * np.log10(self.window_rms(window_len) / self.max_possible_amplitude)
+
+    def silence_thresh_amplitude(self, silence_thresh):
+        return db_to_float(silence_thresh) * self.max_possible_amplitude
+
+    def detect_silence(self, min_silence_len=1000, silence_thresh=-16):
+        silence_starts = np.flatnonzero(self.window_rms(min_silence_len) <= self.silence_thresh_amplitude(silence_thresh))
+        if len(silence_starts) == 0:
+            return []
+        # silent windows that overlap (or touch) are combined into the same silent range
+        gaps = np.diff(silence_starts) > min_silence_len
+        range_starts = silence_starts[np.concatenate(([True], gaps))]
+        range_ends = silence_starts[np.concatenate((gaps, [True]))] + min_silence_len
+        return np.column_stack((range_starts, range_ends)).tolist()
+
+    def detect_nonsilent(self, min_silence_len=1000, silence_thresh=-16):
+        silent_ranges = self.detect_silence(min_silence_len, silence_thresh)
+        if not silent_ranges:
+            return [[0, self.length_ms]]
+        if silent_ranges[0] == [0, self.length_ms]:
+            return []
+
+        silent_ranges = np.array(silent_ranges)
+        starts = np.concatenate(([0], silent_ranges[:, 1]))
+        ends = np.concatenate((silent_ranges[:, 0], [self.length_ms]))
+        if silent_ranges[-1, 1] == self.length_ms:
+            starts, ends = starts[:-1], ends[:-1]
+        if starts[0] == 0 and ends[0] == 0:
+            starts, ends = starts[1:], ends[1:]
+        return np.column_stack((starts, ends)).tolist()
+
+    def split_ranges(self, min_silence_len=1000, silence_thresh=-16, keep_silence=100):
+        """[start, end] millisecond ranges of the chunks pydub.silence.split_on_silence would return"""
+        if isinstance(keep_silence, bool):
+            keep_silence = self.length_ms if keep_silence else 0
+        nonsilent = self.detect_nonsilent(min_silence_len, silence_thresh)
+        if not nonsilent:
+            return []
+
+        nonsilent = np.array(nonsilent)
+        starts = nonsilent[:, 0] - keep_silence
+        ends = nonsilent[:, 1] + keep_silence
+        # when the kept silence of neighbouring chunks overlaps, split it evenly between the two
+        overlapping = starts[1:] < ends[:-1]
+        midpoints = (ends[:-1] + starts[1:]) // 2
+        ends[:-1] = np.where(overlapping, midpoints, ends[:-1])
+        starts[1:] = np.where(overlapping, midpoints, starts[1:])
+        return np.column_stack((np.maximum(starts, 0), np.minimum(ends, self.length_ms))).tolist()
+
+
+def split_on_silence(audio_segment, min_silence_len=1000, silence_thresh=-16, keep_silence=100, envelope=None):
+    """
+    Drop-in replacement for pydub.silence.split_on_silence.
+    Pass in a precomputed envelope to avoid rescanning the audio when splitting it repeatedly.
+    """
+    if envelope is None:
+        envelope = LoudnessEnvelope.from_segment(audio_segment)
+    return [audio_segment[start:end]
+            for start, end in envelope.split_ranges(min_silence_len, silence_thresh, keep_silence)]
+
+
+def _sliding_extreme(values, window, accumulate):
+    # van Herk / Gil-Werman: prefix and suffix extremes within blocks of the window size, O(n) for any window
+    n = len(values) - window + 1
+    blocks = -(-len(values) // window)
+    fill = np.inf if accumulate is np.minimum else -np.inf
+    padded = np.concatenate((values, np.full(blocks * window - len(values), fill))).reshape(blocks, window)
+    prefix = accumulate.accumulate(padded, axis=1).ravel()
+    suffix = accumulate.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+    return accumulate(suffix[:n], prefix[window - 1:window - 1 + n])
+
+
+class ThresholdIndex:
+    """
+    Chunk count and chunk duration of a split at *any* silence threshold, without splitting.
+
+    For every millisecond we store the rms of the quietest min_silence_len window covering it, i.e. the
+    loudness at which it becomes part of a silent run. A millisecond is in a chunk for every threshold
+    below that, so for a given threshold the chunks are the runs of milliseconds above it. Keeping those
+    levels sorted turns the number of runs and their total length (kept silence included) into a couple
+    of binary searches.
+    """
+
+    def __init__(self, envelope, min_silence_len=1000, keep_silence=100):
+        self.envelope = envelope
+        self.min_silence_len = min_silence_len
+        length_ms = envelope.length_ms
+        if isinstance(keep_silence, bool):
+            keep_silence = length_ms if keep_silence else 0
+
+        rms = envelope.window_rms(min_silence_len)
+        if len(rms):
+            edge = np.full(min_silence_len - 1, np.inf)
+            join_level = _sliding_extreme(np.concatenate((edge, rms, edge)), min_silence_len, np.minimum)
+        else:
+            # too short to hold any silence
+            join_level = np.full(length_ms, np.inf)
+
+        # a chunk starts wherever a millisecond is loud and the one before it isn't
+        self._loud_ms = np.sort(join_level)
+        self._loud_pairs = np.sort(np.minimum(join_level[1:], join_level[:-1]))
+
+        # chunks keep up to keep_silence either side of their loud part
+        if keep_silence >= length_ms:
+            kept_level = np.full(length_ms, join_level.max() if length_ms else -np.inf)
+        else:
+            edge = np.full(keep_silence, -np.inf)
+            kept_level = _sliding_extreme(np.concatenate((edge, join_level, edge)), 2 * keep_silence + 1, np.maximum)
+        self._kept_ms = np.sort(kept_level)
+
+    @staticmethod
+    def _count_above(sorted_levels, level):
+        return len(sorted_levels) - np.searchsorted(sorted_levels, level, side='right')
+
+    def chunk_count(self, silence_thresh):
+        level = self.envelope.silence_thresh_amplitude(silence_thresh)
+        return int(self._count_above(self._loud_ms, level) - self._count_above(self._loud_pairs, level))
+
+    def total_duration(self, silence_thresh):
+        """seconds of audio that end up in chunks"""
+        return self._count_above(self._kept_ms, self.envelope.silence_thresh_amplitude(silence_thresh)) / 1000.0
+
+    def avg_chunk_duration(self, silence_thresh):
+        count = self.chunk_count(silence_thresh)
+        return self.total_duration(silence_thresh) / count if count else None
+
+    def find_silence_thresh(self, min_chunk_length, max_chunk_length, initial_silence_thresh=-46,
+                            lowest_thresh=-96, highest_thresh=0, thresh_step=1):
+        """
+        Tries every threshold from lowest_thresh to highest_thresh, returning the one nearest to
+        initial_silence_thresh whose average chunk duration is within [min_chunk_length, max_chunk_length].
+        If none are, returns the threshold whose average comes closest to that range.
+        """
+        best = None
+        for silence_thresh in np.arange(lowest_thresh, highest_thresh + thresh_step, thresh_step).tolist():
+            avg_chunk_duration = self.avg_chunk_duration(silence_thresh)
+            if avg_chunk_duration is None:
+                continue
+            miss = max(min_chunk_length - avg_chunk_duration, avg_chunk_duration - max_chunk_length, 0)
+            rank = (miss, abs(silence_thresh - initial_silence_thresh))
+            if best is None or rank < best[0]:
+                best = (rank, silence_thresh)
+        return None if best is None else best[1]
@@ -0,0 +1,63 @@
+import numpy as np
+from pydub import AudioSegment
+
+# deterministic synthetic audio for tests and benchmarks, so neither needs real recordings or ffmpeg
+
+
+def make_bursts(pattern, frame_rate=8000, channels=2, seed=0):
+    # pattern is a list of (duration ms, amplitude) - loud tones separated by quieter noise
+    rng = np.random.default_rng(seed)
+    parts = []
+    for duration_ms, amplitude in pattern:
+        n = int(frame_rate * duration_ms / 1000)
+        t = np.arange(n) / frame_rate
+        part = np.clip(amplitude * np.sin(2 * np.pi * 220 * t) + rng.normal(0, 30, n), -32768, 32767)
+        parts.append(np.repeat(part.astype(np.int16)[:, None], channels, axis=1))
+    samples = np.concatenate(parts)
+    return AudioSegment(samples.tobytes(), sample_width=2, frame_rate=frame_rate, channels=channels)
+
+
+def three_utterances(**kwargs):
+    # utterances of 6, 7 and 8 sec between 1 sec pauses, which chunk into exactly three chunks of 5 - 15 sec
+    return make_bursts([(1000, 0), (6000, 8000), (1000, 0), (7000, 8000), (1000, 0), (8000, 8000), (1000, 0)],
+                       **kwargs)
+
+
+def uneven_levels(frame_rate=11025, **kwargs):
+    # bursts at several levels, some next to low noise rather than silence, so each silence threshold splits it
+    # differently. the odd frame rate means millisecond slices don't line up with frames
+    return make_bursts([(700, 0), (2000, 8000), (1200, 500), (1500, 3000), (950, 0), (1800, 12000), (400, 0),
+                        (1000, 6000), (1300, 0)], frame_rate=frame_rate, **kwargs)
+
+
+def synthetic_track(duration_s, seed=0, speech_ms=(2000, 9000), pause_ms=(1000, 2500), amplitude=8000,
+                    stretch=1.0, frame_rate=16000, channels=1):
+    """
+    Something shaped like a narrated chapter: tone bursts of random length ("utterances") separated by random
+    pauses of low level noise, duration_s long. stretch scales the bursts, like a slower or faster reader.
+
+    Returns the audio and the [start, end] millisecond ranges of the bursts in it.
+    """
+    rng = np.random.default_rng(seed)
+    pattern = []
+    burst_ranges = []
+    position = 0
+    total_ms = int(duration_s * 1000)
+    while position < total_ms:
+        pause = int(rng.integers(*pause_ms))
+        speech = int(rng.integers(*speech_ms) * stretch)
+        if position + pause + speech + pause_ms[0] > total_ms:
+            pattern.append((total_ms - position, 0))
+            break
+        pattern.append((pause, 0))
+        pattern.append((speech, amplitude))
+        burst_ranges.append([position + pause, position + pause + speech])
+        position += pause + speech
+    return make_bursts(pattern, frame_rate=frame_rate, channels=channels, seed=seed), burst_ranges
+
+
+def synthetic_pair(duration_s, seed=0, **kwargs):
+    # a base track and a target track "read" 20% slower, with the same utterance lengths underneath
+    base, base_bursts = synthetic_track(duration_s, seed=seed, **kwargs)
+    target, target_bursts = synthetic_track(duration_s * 1.2, seed=seed, stretch=1.2, **kwargs)
+    return (base, base_bursts), (target, target_bursts)
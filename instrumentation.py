@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profile:
+    """
+    Wall and CPU time spent in each stage of the pipeline, plus counters (attempts, chunks, ffmpeg processes..).
+    Stages can nest and repeat, their times add up. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            # process_time covers every thread, so with threads running side by side this overcounts
+            self._add_stage(name, time.perf_counter() - wall_start, time.process_time() - cpu_start, 1)
+
+    def _add_stage(self, name, wall_seconds, cpu_seconds, calls):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+            stage["wall_seconds"] += wall_seconds
+            stage["cpu_seconds"] += cpu_seconds
+            stage["calls"] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        # other is the to_dict() of a profile from another process
+        for name, stage in other["stages"].items():
+            self._add_stage(name, stage["wall_seconds"], stage["cpu_seconds"], stage["calls"])
+        for name, n in other["counters"].items():
+            self.count(name, n)
+
+    def to_dict(self):
+        with self._lock:
+            return {"stages": {name: dict(stage) for name, stage in self.stages.items()},
+                    "counters": dict(self.counters)}
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# the profile of the current process
+profile = Profile()
+
+
+def stage(name):
+    return profile.stage(name)
+
+
+def count(name, n=1):
+    profile.count(name, n)
+
+
+def reset():
+    global profile
+    profile = Profile()
+
+
+def run_profiled(fn, *args, **kwargs):
+    """For worker processes: runs fn with a fresh profile, returning its result and the profile to merge back"""
+    reset()
+    result = fn(*args, **kwargs)
+    return result, profile.to_dict()
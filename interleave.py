@@ -1,14 +1,31 @@
 #!/usr/bin/env python3
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
+from pydub.exceptions import CouldntEncodeError
 from pydub.utils import mediainfo
+from audio_cache import AudioCache
+from autosync import find_sync_points, track_features
+from chunk_store import ChunkStore, ChunkStoreWriter, save_chunk_store
+from envelope import LoudnessEnvelope, ThresholdIndex, split_on_silence
+from streaming import StreamingSplitter, probe_audio, stream_pcm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import os
 from os import makedirs
 from os.path import exists
 import sys
+import subprocess
+import tempfile
+import threading
 import argparse
+import hashlib
+import json
 import re
-import pprint
+import shutil
 import glob
+import logging
+import instrumentation
+
+log = logging.getLogger(__name__)
 
 # TODO: proper arg parsing or a config file
 base_lang = "English"
@@ -20,9 +37,23 @@ target_lang_code = "ES"
 class LangChunk:
 
     def __init__(self, audio_segment, lang_title, **kwargs):
-        self.segment = audio_segment
+        self._segment = audio_segment
         self.lang_title = lang_title
         self.src_idx = kwargs.pop("src_idx", None)
+        self.silence_thresh = kwargs.pop("silence_thresh", None)
+        # chunks from a chunk store only read their audio in when it's needed
+        self._load_segment = kwargs.pop("load_segment", None)
+        self.duration_seconds = kwargs.pop("duration_seconds", None)
+        if self.duration_seconds is None:
+            self.duration_seconds = audio_segment.duration_seconds
+
+    @property
+    def segment(self):
+        # read in again every time rather than kept, so going through a track's chunks one at a time
+        # only ever has one of them in memory
+        if self._segment is None:
+            return self._load_segment()
+        return self._segment
 
 
 class DualLangSection:
@@ -41,27 +72,44 @@ class DualLangSection:
 
 def create_audio_chunks(audio_segment, min_chunk_length, max_chunk_length,title,
                         initial_silence_thresh=-46, thresh_incr_size=3,
-                        discard_initial_chunks=0):
+                        discard_initial_chunks=0, min_silence_len=900, keep_silence=900,
+                        threshold_search="step", envelope=None):
     silence_thresh = initial_silence_thresh
     attempts = 0
     chunks = []
     max_attempts = 15
-    # TODO: binary search / bisection with sensible initial range may be faster
-    while attempts < max_attempts:
+    # loudness only has to be measured once, each attempt below just looks up the windows again
+    if envelope is None:
+        envelope = LoudnessEnvelope.from_segment(audio_segment)
+    if threshold_search == "index":
+        # count chunks for every threshold up front and split just once, with the best one
+        index = ThresholdIndex(envelope, min_silence_len=min_silence_len, keep_silence=keep_silence)
+        found_thresh = index.find_silence_thresh(min_chunk_length, max_chunk_length, initial_silence_thresh)
+        if found_thresh is not None:
+            silence_thresh = found_thresh
+        log.info("Chunks: %s, avg chunk duration: %s sec with silence threshold %sdb",
+                 index.chunk_count(silence_thresh), index.avg_chunk_duration(silence_thresh), silence_thresh)
+        chunks = split_on_silence(audio_segment, min_silence_len=min_silence_len, silence_thresh=silence_thresh,
+                                  keep_silence=keep_silence, envelope=envelope)
+        chunks_thresh = silence_thresh
+    while threshold_search == "step" and attempts < max_attempts:
         attempts += 1
-        print("Attempt #{}".format(attempts))
-        chunks = split_on_silence(audio_segment, min_silence_len=900, silence_thresh=silence_thresh, keep_silence=900)
+        instrumentation.count("threshold_search_attempts")
+        log.debug("Attempt #%s", attempts)
+        chunks = split_on_silence(audio_segment, min_silence_len=min_silence_len, silence_thresh=silence_thresh,
+                                  keep_silence=keep_silence, envelope=envelope)
+        chunks_thresh = silence_thresh
         if len(chunks) == 0:
             # we didn't manage to split the audio at all
             # try again with a louder threshold
-            print("Chunks: {} with silence threshold {}db".format(len(chunks), silence_thresh))
+            log.debug("Chunks: %s with silence threshold %sdb", len(chunks), silence_thresh)
             silence_thresh = silence_thresh + thresh_incr_size
             continue
-        print("Chunks: {}".format(len(chunks)))
+        log.debug("Chunks: %s", len(chunks))
         duration = sum(chunk.duration_seconds for chunk in chunks)
-        print("Audio length in seconds: {}".format(duration))
+        log.debug("Audio length in seconds: %s", duration)
         avg_chunk_duration = duration / len(chunks)
-        print("Avg chunk duration : {} sec with silence threshold {}db".format(avg_chunk_duration, silence_thresh))
+        log.debug("Avg chunk duration : %s sec with silence threshold %sdb", avg_chunk_duration, silence_thresh)
 
         # if chunks are too long then we have to have a louder silence threshold, so more is considered silence
         # and so more splitting is done
@@ -71,40 +119,70 @@ def create_audio_chunks(audio_segment, min_chunk_length, max_chunk_length,title,
         elif avg_chunk_duration < min_chunk_length:
             silence_thresh = silence_thresh - thresh_incr_size
         elif attempts >= max_attempts:
-            print("Max attempts to find best chunk length exceeded, continuing with what we have")
+            log.warning("Max attempts to find best chunk length exceeded, continuing with what we have")
         # success!
         else:
-            print("Successfully chunked the audio with average length {}, more than min desired {} sec, and less than "
-                  "max desired {} sec".format(
-                avg_chunk_duration, min_chunk_length, max_chunk_length))
+            log.info("Successfully chunked the audio with average length %s, more than min desired %s sec, and less "
+                     "than max desired %s sec", avg_chunk_duration, min_chunk_length, max_chunk_length)
             break
-    return [LangChunk(x,title,src_idx=i) for i, x in enumerate(chunks[discard_initial_chunks:])]
+    log.info("%s chunks were split with silence threshold %sdb, pass this threshold back in to reuse them",
+             title, chunks_thresh)
+    return [LangChunk(x,title,src_idx=i,silence_thresh=chunks_thresh) for i, x in enumerate(chunks[discard_initial_chunks:])]
+
+def stream_audio_chunks(audio_path, title, silence_thresh=-37, discard_initial_chunks=0,
+                        min_silence_len=900, keep_silence=900, block_ms=10000):
+    # decodes and splits the audio a block at a time, so memory use doesn't depend on how long the audio is
+    # there's no looking ahead, so the silence threshold has to be known already (no threshold search)
+    frame_rate, channels = probe_audio(audio_path)
+    splitter = StreamingSplitter(frame_rate, channels, min_silence_len=min_silence_len,
+                                 silence_thresh=silence_thresh, keep_silence=keep_silence)
+    src_idx = 0
+    for samples in stream_pcm(audio_path, frame_rate, channels, block_ms=block_ms):
+        for chunk in splitter.feed(samples):
+            if src_idx >= discard_initial_chunks:
+                yield LangChunk(chunk, title, src_idx=src_idx - discard_initial_chunks, silence_thresh=silence_thresh)
+            src_idx += 1
+    for chunk in splitter.finish():
+        if src_idx >= discard_initial_chunks:
+            yield LangChunk(chunk, title, src_idx=src_idx - discard_initial_chunks, silence_thresh=silence_thresh)
+        src_idx += 1
 
 def load_audio_chunks(chunkdir, title, lang_title):
-    print("Searching for chunks with: {}/*-{}-*.mp3".format(chunkdir, title))
+    if ChunkStore.exists(chunkdir, title):
+        store = ChunkStore(chunkdir, title)
+        log.info("Found chunk store with %s chunks for %s in %s", len(store), title, chunkdir)
+        return [LangChunk(None, lang_title, src_idx=chunk["src_idx"], silence_thresh=store.silence_thresh,
+                          duration_seconds=chunk["duration_seconds"], load_segment=partial(store.segment, i))
+                for i, chunk in enumerate(store.chunks)]
+
+    log.info("Searching for chunks with: %s/*-%s-*.mp3", chunkdir, title)
     # chunks need to be loaded in order !
     # our chunks are outputted with chunk number prefix (formatted for lexical sorting), so lexical order
     chunk_files = sorted(glob.glob("{}/*-{}-*.mp3".format(chunkdir, title)))
-    print("Found {} chunk files".format(len(chunk_files)))
-    print("Loading chunk files..", end=' ')
+    log.info("Found %s chunk files", len(chunk_files))
     chunks=[]
     for file in chunk_files:
         chunk_segment = AudioSegment.from_mp3(file)
+        instrumentation.count("ffmpeg_processes", 2)
         pattern = '.*-([0-9]+).mp3'
         m = re.match(pattern, file)
         idx = int(m.group(1))
-        print(idx , end=' ')
+        log.debug("Loaded chunk file %s", idx)
         chunks.append(LangChunk(chunk_segment, lang_title, src_idx=idx))
-    print("... Finished!")
     return chunks
 
 
-def interleave_matching_audio_segments(base_lang_chunks, tgt_lang_chunks):
-    tgt_lang_duration = sum(chunk.segment.duration_seconds for chunk in tgt_lang_chunks)
-    print("{} audio length in seconds: {}".format(target_lang, tgt_lang_duration))
-
-    base_lang_duration = sum(chunk.segment.duration_seconds for chunk in base_lang_chunks)
-    print("{} audio length in seconds: {}".format(base_lang, base_lang_duration))
+def plan_interleave(base_durations, tgt_durations):
+    """
+    Works out the order to play the chunks of two audio tracks in, from the chunk durations alone.
+    Returns a list of ("base" | "target", chunk index) pairs.
+    """
+    tgt_lang_duration = sum(tgt_durations)
+    base_lang_duration = sum(base_durations)
+    log.info("%s audio length in seconds: %s", target_lang, tgt_lang_duration)
+    log.info("%s audio length in seconds: %s", base_lang, base_lang_duration)
+    # formatting the progress messages costs more than the planning itself, only do it when they're shown
+    debug = log.isEnabledFor(logging.DEBUG)
 
     # because translations and emphasis is different between readings and languages,
     # two audio tracks won't make uniform progress through the track
@@ -114,107 +192,332 @@ def interleave_matching_audio_segments(base_lang_chunks, tgt_lang_chunks):
     # makes sense to have this about the same size as average chunk length
     # this should have the effect of consolidating chunks that are too short
     # N.B. float division here
-    tgt_lang_avg_chunk_duration = tgt_lang_duration / len(tgt_lang_chunks)
+    num_tgt_chunks = len(tgt_durations)
+    num_base_chunks = len(base_durations)
+    tgt_lang_avg_chunk_duration = tgt_lang_duration / num_tgt_chunks
     progress_fudge_factor = tgt_lang_avg_chunk_duration / ( tgt_lang_duration * 4 )
 
-    tgt_lang_play_time = tgt_lang_chunks[0].segment.duration_seconds
-    base_lang_play_time = base_lang_chunks[0].segment.duration_seconds
-    lang_chunks = []
+    tgt_lang_play_time = tgt_durations[0]
+    base_lang_play_time = base_durations[0]
+    plan = []
     base_lang_idx = -1
     tgt_lang_idx = -1
-    out_idx = 0
 
     # loop until all chunks have been added, from both audio tracks
-    while base_lang_idx < len(base_lang_chunks) - 1 or tgt_lang_idx < len(tgt_lang_chunks) - 1:
-        out_idx += 1
-        print(".")
-
+    while base_lang_idx < num_base_chunks - 1 or tgt_lang_idx < num_tgt_chunks - 1:
         # projected progress, including the next chunk length in each audio track
         tgt_lang_progress = float(tgt_lang_play_time) / tgt_lang_duration
         base_lang_progress = float(base_lang_play_time) / base_lang_duration
 
-        print("{} play time is now: {}, progress: {}".format(target_lang_code, tgt_lang_play_time, tgt_lang_progress))
-        print("{} play time is now: {}, progress: {}".format(base_lang_code, base_lang_play_time, base_lang_progress))
+        if debug:
+            log.debug("%s play time is now: %s, progress: %s", target_lang_code, tgt_lang_play_time, tgt_lang_progress)
+            log.debug("%s play time is now: %s, progress: %s", base_lang_code, base_lang_play_time, base_lang_progress)
 
         # always start off with the target lang
         if tgt_lang_idx == -1:
             tgt_lang_idx += 1
+            if debug:
+                log.debug("Appending %s chunk number %s, of length %s", target_lang_code, tgt_lang_idx, tgt_durations[tgt_lang_idx])
 
-            print("Appending {} chunk number {}, of length {}".format(target_lang_code, tgt_lang_idx, tgt_lang_chunks[tgt_lang_idx].segment.duration_seconds))
-            print("{} play time is now: {}, progress: {}".format(target_lang_code, tgt_lang_play_time, tgt_lang_progress))
-
-            lang_chunks.append(tgt_lang_chunks[0])
-            if tgt_lang_idx+1 < len(tgt_lang_chunks):
-                tgt_lang_play_time += tgt_lang_chunks[tgt_lang_idx + 1].segment.duration_seconds
+            plan.append(("target", 0))
+            if tgt_lang_idx+1 < num_tgt_chunks:
+                tgt_lang_play_time += tgt_durations[tgt_lang_idx + 1]
 
         # when do we want to take the base chunk?
         # if target lang progress exceeds the base lang by a certain amount already ("fudge factor"), take the base lang chunk to catch up
         # otherwise if all target lang chunks have already been added
         elif tgt_lang_progress - progress_fudge_factor > base_lang_progress \
-                or tgt_lang_idx >= len(tgt_lang_chunks) - 1:
+                or tgt_lang_idx >= num_tgt_chunks - 1:
             base_lang_idx += 1
-            if base_lang_idx < len(base_lang_chunks):
-                print("Appending {} chunk number {}, of length {}".format(base_lang_code, base_lang_idx, base_lang_chunks[base_lang_idx].segment.duration_seconds))
-                print("{} play time is now: {}, progress: {}".format(base_lang_code, base_lang_play_time, base_lang_progress))
+            if base_lang_idx < num_base_chunks:
+                if debug:
+                    log.debug("Appending %s chunk number %s, of length %s", base_lang_code, base_lang_idx, base_durations[base_lang_idx])
 
-                lang_chunks.append(base_lang_chunks[base_lang_idx])
-                if base_lang_idx+1 < len(base_lang_chunks):
+                plan.append(("base", base_lang_idx))
+                if base_lang_idx+1 < num_base_chunks:
                     # want calculation of progress in the next iteration to be the projected progress if another base chunk is chosen
-                    base_lang_play_time += base_lang_chunks[base_lang_idx + 1].segment.duration_seconds
-            else:
-                print("Reached last {} chunk in audio".format(base_lang_code))
+                    base_lang_play_time += base_durations[base_lang_idx + 1]
+            elif debug:
+                log.debug("Reached last %s chunk in audio", base_lang_code)
         # otherwise, we normally want to make progress with the target language first
         else:
             tgt_lang_idx += 1
-            if tgt_lang_idx < len(tgt_lang_chunks):
-                print("Appending {} chunk number {}, of length {}".format(target_lang_code, tgt_lang_idx, tgt_lang_chunks[tgt_lang_idx].segment.duration_seconds))
-                print("{} play time is now: {}, progress: {}".format(target_lang_code, tgt_lang_play_time, tgt_lang_progress))
+            if tgt_lang_idx < num_tgt_chunks:
+                if debug:
+                    log.debug("Appending %s chunk number %s, of length %s", target_lang_code, tgt_lang_idx, tgt_durations[tgt_lang_idx])
 
-                lang_chunks.append(tgt_lang_chunks[tgt_lang_idx])
-                if (tgt_lang_idx+1 < len(tgt_lang_chunks)):
+                plan.append(("target", tgt_lang_idx))
+                if (tgt_lang_idx+1 < num_tgt_chunks):
                     # want calculation of progress in the next iteration to be the projected progress if another target chunk is chosen
-                    tgt_lang_play_time += tgt_lang_chunks[tgt_lang_idx + 1].segment.duration_seconds
-            else:
-                print("Reached last {} chunk in audio section".format(target_lang_code))
+                    tgt_lang_play_time += tgt_durations[tgt_lang_idx + 1]
+            elif debug:
+                log.debug("Reached last %s chunk in audio section", target_lang_code)
 
-    return lang_chunks
+    return plan
 
 
-def export_bilingual_audio_track(lang_chunks, outdir):
-    bilingual_audio = AudioSegment.empty()
-    for chunk in lang_chunks:
-        bilingual_audio += chunk.segment
-    print("Exporting interleaved audio")
-    bilingual_audio += AudioSegment.silent(duration=3000)
-    bilingual_audio.export("{}/audio-out.mp3".format(outdir),
-                           format="mp3",
-                           tags={"album": "output-audio-{}-{}".format(base_lang_code, target_lang_code), "artist": "bv", "title": "audio-out"})
-    print("Exported interleaved audio")
-
-
-def export_each_audio_chunk(lang_chunks, outdir, base_lang_title, base_lang_code, target_lang_code):
-    idx = 0
-    for chunk in lang_chunks:
-        idx += 1
+def plan_sections(base_durations, tgt_durations, sync_sections):
+    # plans each section between sync points on its own, with chunk indexes into the whole of each track
+    if sync_sections is None or len(sync_sections) == 0:
+        return plan_interleave(base_durations, tgt_durations)
+    plan = []
+    log.info("Going to interleave %s sections in sequence", len(sync_sections))
+    for i, section in enumerate(sync_sections):
+        log.info("Interleaving chunks for section %s, starting from %s:%s, finishing at %s:%s",
+                 i, section.base_start, section.tgt_start, section.base_end, section.tgt_end)
+        starts = {"base": section.base_start, "target": section.tgt_start}
+        plan += [(lang, starts[lang] + idx) for lang, idx in plan_interleave(
+            base_durations[section.base_start:section.base_end], tgt_durations[section.tgt_start:section.tgt_end])]
+    return plan
+
+
+def interleave_matching_audio_segments(base_lang_chunks, tgt_lang_chunks):
+    plan = plan_interleave([chunk.duration_seconds for chunk in base_lang_chunks],
+                           [chunk.duration_seconds for chunk in tgt_lang_chunks])
+    lang_chunks = {"base": base_lang_chunks, "target": tgt_lang_chunks}
+    return [lang_chunks[lang][idx] for lang, idx in plan]
+
+
+def assemble_audio(segments, trailing_silence_ms=0):
+    # gives the same audio as adding the segments together one at a time, but copies each one just once,
+    # rather than copying everything added so far on every addition
+    segments = list(segments)
+    if trailing_silence_ms:
+        segments.append(AudioSegment.silent(duration=trailing_silence_ms))
+    if not segments:
+        return AudioSegment.empty()
+    # adding segments converts them all to the highest channel count, frame rate and sample width between them
+    channels = max(segment.channels for segment in segments)
+    frame_rate = max(segment.frame_rate for segment in segments)
+    sample_width = max(segment.sample_width for segment in segments)
+    data = b"".join(segment.set_channels(channels).set_frame_rate(frame_rate).set_sample_width(sample_width).raw_data
+                    for segment in segments)
+    return AudioSegment(data, sample_width=sample_width, frame_rate=frame_rate, channels=channels)
+
+
+# ffmpeg's names for raw signed PCM of each sample width
+RAW_PCM_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
+
+def stream_export(segments, out_path, frame_rate, channels, sample_width=2, trailing_silence_ms=0,
+                  format="mp3", tags=None):
+    # pipes the segments' audio straight into the encoder, so the whole output is never held in memory
+    # segments in any other format are converted to the given one on the way
+    command = [AudioSegment.converter, "-y", "-v", "error", "-nostats", "-f", RAW_PCM_FORMATS[sample_width],
+               "-ar", str(frame_rate), "-ac", str(channels), "-i", "-"]
+    for key, value in (tags or {}).items():
+        command.extend(["-metadata", "{}={}".format(key, value)])
+    if tags and format == "mp3":
+        command.extend(["-id3v2_version", "4"])
+    command.extend(["-f", format, out_path])
+
+    instrumentation.count("ffmpeg_processes")
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    # read alongside the audio, so a lot of error output can't fill the pipe and stall ffmpeg while we write to it
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    broken_pipe = False
+    try:
+        for segment in segments:
+            process.stdin.write(segment.set_channels(channels).set_frame_rate(frame_rate)
+                                .set_sample_width(sample_width).raw_data)
+        if trailing_silence_ms:
+            process.stdin.write(bytes(int(trailing_silence_ms * frame_rate / 1000) * channels * sample_width))
+    except BrokenPipeError:
+        # ffmpeg stopped reading, most likely it failed, what it said about it is more use than this
+        broken_pipe = True
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            broken_pipe = True
+        process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+    if process.returncode != 0 or broken_pipe:
+        raise CouldntEncodeError("Encoding failed. ffmpeg returned error code: {}\n\n{}".format(
+            process.returncode, b"".join(stderr).decode(errors="replace")))
+
+
+def export_bilingual_audio_track(lang_chunks, outdir, stream=False):
+    tags = {"album": "output-audio-{}-{}".format(base_lang_code, target_lang_code), "artist": "bv", "title": "audio-out"}
+    log.info("Exporting interleaved audio")
+    if stream and lang_chunks:
+        # output takes the format of the first chunk, the chunks of a track all share the same format anyway
+        first = lang_chunks[0].segment
+        stream_export((chunk.segment for chunk in lang_chunks), "{}/audio-out.mp3".format(outdir),
+                      first.frame_rate, first.channels, sample_width=first.sample_width,
+                      trailing_silence_ms=3000, format="mp3", tags=tags)
+    else:
+        bilingual_audio = assemble_audio((chunk.segment for chunk in lang_chunks), trailing_silence_ms=3000)
+        instrumentation.count("ffmpeg_processes")
+        bilingual_audio.export("{}/audio-out.mp3".format(outdir), format="mp3", tags=tags)
+    log.info("Exported interleaved audio")
+
+
+# how interleaved chunks are encoded, output files encoded any other way are never reused
+OUTPUT_ENCODING = {"format": "mp3", "id3v2_version": 4}
+# records what's in each output file, so a later run can tell which ones it can keep
+OUTPUT_MANIFEST = "output-manifest.json"
+
+def output_chunk_files(lang_chunks, outdir, base_lang_title, base_lang_code, target_lang_code):
+    # file name and tags for each interleaved chunk, numbered in the order they're played
+    files = []
+    for idx, chunk in enumerate(lang_chunks, start=1):
         idx_str = str(idx).zfill(len(str(len(lang_chunks))))
-        bilingual_audio = AudioSegment.empty()
-        bilingual_audio += chunk.segment
-        bilingual_audio.export("{}/{}-{}-{}.mp3".format(outdir, idx_str, chunk.lang_title, chunk.src_idx),
-                               format="mp3",
-                               tags={"album": "{}-{}-{}".format(base_lang_title, base_lang_code, target_lang_code),
-                                     "artist": "bv-interleaved-audio",
-                                     "title": "{}-{}-{}-{}".format(idx_str, base_lang_title,
-                                                                   chunk.lang_title, chunk.src_idx),
-                                     "track": idx_str
-                                     },
-                               )
-    print("Exported interleaved audio")
+        files.append(("{}/{}-{}-{}.mp3".format(outdir, idx_str, chunk.lang_title, chunk.src_idx),
+                      {"album": "{}-{}-{}".format(base_lang_title, base_lang_code, target_lang_code),
+                       "artist": "bv-interleaved-audio",
+                       "title": "{}-{}-{}-{}".format(idx_str, base_lang_title, chunk.lang_title, chunk.src_idx),
+                       "track": idx_str
+                       }))
+    return files
+
+def export_audio_chunk(chunk, path, tags):
+    instrumentation.count("ffmpeg_processes")
+    chunk.segment.export(path, format=OUTPUT_ENCODING["format"], tags=tags,
+                         id3v2_version=str(OUTPUT_ENCODING["id3v2_version"]))
+
+def export_each_audio_chunk(lang_chunks, outdir, base_lang_title, base_lang_code, target_lang_code, jobs=1):
+    files = output_chunk_files(lang_chunks, outdir, base_lang_title, base_lang_code, target_lang_code)
+    # the files are about to change, a later incremental export mustn't go by what they had in them before
+    remove_output_manifest(outdir)
+    # each export runs its own ffmpeg process, threads are enough to keep several of them going at once
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        list(executor.map(export_audio_chunk, lang_chunks, *zip(*files)))
+    instrumentation.count("output_chunks", len(files))
+    save_output_manifest(outdir, output_manifest(lang_chunks, [chunk_content_key(chunk) for chunk in lang_chunks],
+                                                 files))
+    log.info("Exported interleaved audio")
+
+
+def chunk_content_key(chunk):
+    # identifies a chunk's audio, whichever track position or file name it ends up with
+    segment = chunk.segment
+    digest = hashlib.sha256("{} {} {}".format(segment.sample_width, segment.frame_rate, segment.channels).encode())
+    digest.update(segment.raw_data)
+    return digest.hexdigest()
+
+def load_output_manifest(outdir):
+    path = "{}/{}".format(outdir, OUTPUT_MANIFEST)
+    if not exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def remove_output_manifest(outdir):
+    path = "{}/{}".format(outdir, OUTPUT_MANIFEST)
+    if exists(path):
+        os.remove(path)
+
+def output_manifest(lang_chunks, keys, files):
+    return {"encoding": OUTPUT_ENCODING, "files": [
+        {"file": os.path.basename(path), "lang": chunk.lang_title, "src_idx": chunk.src_idx, "content": key,
+         "tags": tags} for chunk, key, (path, tags) in zip(lang_chunks, keys, files)]}
+
+def save_output_manifest(outdir, manifest):
+    path = "{}/{}".format(outdir, OUTPUT_MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def retag_audio_chunk(src_path, path, tags):
+    # copies the encoded audio as it is, only the tags are replaced
+    command = [AudioSegment.converter, "-y", "-v", "error", "-i", src_path, "-map", "0", "-map_metadata", "-1",
+               "-c", "copy"]
+    for key, value in tags.items():
+        command.extend(["-metadata", "{}={}".format(key, value)])
+    command.extend(["-id3v2_version", str(OUTPUT_ENCODING["id3v2_version"]), "-f", OUTPUT_ENCODING["format"], path])
+    instrumentation.count("ffmpeg_processes")
+    # run from the export thread pool, none of them may read from the terminal
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise CouldntEncodeError("Retagging failed. ffmpeg returned error code: {}\n\n{}".format(
+            result.returncode, result.stderr.decode(errors="replace")))
+
+def export_changed_audio_chunks(lang_chunks, outdir, base_lang_title, base_lang_code, target_lang_code, jobs=1):
+    """
+    Like export_each_audio_chunk, but reuses the output of an earlier run recorded in the outdir's output
+    manifest. Only chunks whose audio wasn't already encoded get encoded, files that are still wanted are just
+    renamed, or have their tags rewritten, to fit the new order. Files that are no longer wanted are removed.
+    """
+    files = output_chunk_files(lang_chunks, outdir, base_lang_title, base_lang_code, target_lang_code)
+    keys = [chunk_content_key(chunk) for chunk in lang_chunks]
+
+    # left behind by an export that was interrupted, what's in them isn't recorded anywhere any more
+    for path in glob.glob("{}/.reuse-*".format(outdir)):
+        os.remove(path)
+
+    # earlier outputs by the audio in them, usable only if encoded the same way and still there
+    previous = load_output_manifest(outdir)
+    # files get moved around below, if that's interrupted the manifest would no longer match them
+    remove_output_manifest(outdir)
+    reusable = {}
+    stale = []
+    if previous is not None:
+        for entry in previous["files"]:
+            path = "{}/{}".format(outdir, entry["file"])
+            if previous["encoding"] == OUTPUT_ENCODING and exists(path):
+                reusable.setdefault(entry["content"], []).append((path, entry["tags"]))
+            elif exists(path):
+                stale.append(path)
+
+    to_encode = []
+    to_move = []
+    for chunk, key, (path, tags) in zip(lang_chunks, keys, files):
+        if reusable.get(key):
+            old_path, old_tags = reusable[key].pop(0)
+            to_move.append((old_path, old_tags, path, tags))
+        else:
+            to_encode.append((chunk, path, tags))
+    stale += [path for entries in reusable.values() for path, _ in entries]
+
+    # move reused files out of the way first, new names can be the old names of other files
+    moves = []
+    for i, (old_path, old_tags, path, tags) in enumerate(to_move):
+        tmp_path = "{}/.reuse-{}.{}".format(outdir, i, OUTPUT_ENCODING["format"])
+        os.replace(old_path, tmp_path)
+        moves.append((tmp_path, old_tags, path, tags))
+    for path in stale:
+        os.remove(path)
+
+    retags = []
+    for tmp_path, old_tags, path, tags in moves:
+        if old_tags == tags:
+            os.replace(tmp_path, path)
+        else:
+            retags.append((tmp_path, path, tags))
+
+    def retag(tmp_path, path, tags):
+        retag_audio_chunk(tmp_path, path, tags)
+        os.remove(tmp_path)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(retag, *job) for job in retags]
+        futures += [executor.submit(export_audio_chunk, *job) for job in to_encode]
+        for future in futures:
+            future.result()
+    instrumentation.count("output_chunks", len(files))
+    instrumentation.count("output_chunks_encoded", len(to_encode))
+    instrumentation.count("output_chunks_retagged", len(retags))
+
+    save_output_manifest(outdir, output_manifest(lang_chunks, keys, files))
+    log.info("Exported interleaved audio: %s chunks encoded, %s retagged, %s renamed or unchanged",
+             len(to_encode), len(retags), len(moves) - len(retags))
+
+def export_raw_audio_chunks(raw_chunks, chunkdir, title, lang_code, chunk_format="store"):
+    if chunk_format == "store":
+        save_chunk_store([chunk.segment for chunk in raw_chunks], "{}/{}".format(chunkdir, lang_code), title,
+                         src_idxs=[chunk.src_idx for chunk in raw_chunks],
+                         silence_thresh=raw_chunks[0].silence_thresh if raw_chunks else None)
+        log.info("Exported %s raw audio chunks to chunk store", lang_code)
+        return
 
-def export_raw_audio_chunks(raw_chunks, chunkdir, title, lang_code):
     for chunk in raw_chunks:
         idx_str = str(chunk.src_idx).zfill(len(str(len(raw_chunks))))
         bilingual_audio = AudioSegment.empty()
         bilingual_audio += chunk.segment
+        instrumentation.count("ffmpeg_processes")
         bilingual_audio.export("{}/{}/{}-{}-{}.mp3".format(chunkdir, lang_code, idx_str, title, chunk.src_idx),
                                format="mp3",
                                tags={"album": "{}-{}".format(title, lang_code),
@@ -223,7 +526,52 @@ def export_raw_audio_chunks(raw_chunks, chunkdir, title, lang_code):
                                      "track": idx_str
                                      },
                                )
-    print("Exported {} raw audio chunks".format(lang_code))
+    log.info("Exported %s raw audio chunks", lang_code)
+
+def decode_audio(path, cache=None):
+    # returns the envelope too when it's cached, so it doesn't have to be measured again
+    with instrumentation.stage("decode"):
+        if cache is None:
+            # pydub runs ffprobe for the format, then ffmpeg to decode
+            instrumentation.count("ffmpeg_processes", 2)
+            return AudioSegment.from_mp3(path), None
+        return cache.load(path)
+
+def save_streamed_chunks(lang_chunks, store_dir, title, lang_title, silence_thresh=None):
+    # each chunk is written to the chunk store as soon as it's split off, and let go of,
+    # the chunks handed back read their audio from the store when they need it
+    with ChunkStoreWriter(store_dir, title, silence_thresh=silence_thresh) as writer:
+        for chunk in lang_chunks:
+            writer.add(chunk.segment, chunk.src_idx)
+    return load_audio_chunks(store_dir, title, lang_title)
+
+def chunk_track(audio_path, lang_title, lang_code, title, chunkdir, silence_thresh, offset,
+                threshold_search="step", cache=None, streaming=False, chunk_format="store"):
+    # everything needed to go from one input audio file to its raw chunks, so it can run in a worker process
+    if streaming:
+        if chunkdir is None:
+            raise ValueError("Streaming needs a chunkdir to write chunks to as they're split")
+        with instrumentation.stage("streaming_split"):
+            chunks = save_streamed_chunks(stream_audio_chunks(audio_path, lang_title, silence_thresh=silence_thresh,
+                                                              discard_initial_chunks=offset),
+                                          "{}/{}".format(chunkdir, lang_code), title, lang_title, silence_thresh)
+        instrumentation.count("chunks_{}".format(lang_code), len(chunks))
+        # already in the chunk store, only mp3 files are left to write
+        if chunk_format == "mp3":
+            with instrumentation.stage("raw_chunk_export"):
+                export_raw_audio_chunks(chunks, chunkdir, title, lang_code, chunk_format=chunk_format)
+        return chunks
+    else:
+        audio_segment, envelope = decode_audio(audio_path, cache)
+        with instrumentation.stage("threshold_search"):
+            chunks = create_audio_chunks(audio_segment, 5, 15, lang_title, initial_silence_thresh=silence_thresh,
+                                         discard_initial_chunks=offset, threshold_search=threshold_search,
+                                         envelope=envelope)
+    instrumentation.count("chunks_{}".format(lang_code), len(chunks))
+    if chunkdir is not None:
+        with instrumentation.stage("raw_chunk_export"):
+            export_raw_audio_chunks(chunks, chunkdir, title, lang_code, chunk_format=chunk_format)
+    return chunks
 
 def create_sections_from_sync_points(sync_points, num_base_chunks, num_tgt_chunks):
     if sync_points is None or len(sync_points) == 0:
@@ -255,12 +603,122 @@ def create_sections_from_sync_points(sync_points, num_base_chunks, num_tgt_chunk
 
 
 def validate_section(section):
-    print("validating section: ")
-    pprint.pprint(section)
+    log.debug("validating section: %s", section)
     assert section.base_start < section.base_end
     assert section.tgt_start < section.tgt_end
 
 
+def interleave_chapter(base_audio, target_audio, title, outdir, chunkdir=None, base_offset=0, target_offset=0,
+                       base_audio_silence_threshold=-37, target_audio_silence_threshold=-37, sync_points=None,
+                       threshold_search="step", cache=None, jobs=1, streaming=False, chunk_format="store",
+                       export_jobs=1, dry_run=False, auto_sync=False, reencode_all=False):
+    # one base / target pair of audio files in, interleaved chunks out
+    # returns the interleaved chunks
+    if streaming and chunkdir is None:
+        # streamed chunks go straight to disk rather than being held in memory, somewhere temporary if need be
+        tmp_chunkdir = tempfile.mkdtemp(prefix="interleave-chunks-")
+        try:
+            return interleave_chapter(base_audio, target_audio, title, outdir, chunkdir=tmp_chunkdir,
+                                      base_offset=base_offset, target_offset=target_offset,
+                                      base_audio_silence_threshold=base_audio_silence_threshold,
+                                      target_audio_silence_threshold=target_audio_silence_threshold,
+                                      sync_points=sync_points, threshold_search=threshold_search, cache=cache,
+                                      jobs=jobs, streaming=streaming, chunk_format=chunk_format,
+                                      export_jobs=export_jobs, dry_run=dry_run, auto_sync=auto_sync,
+                                      reencode_all=reencode_all)
+        finally:
+            # the chunks returned still have the store memory-mapped, which windows won't delete
+            shutil.rmtree(tmp_chunkdir, ignore_errors=True)
+    # a dry run writes nothing, so it doesn't need an outdir
+    if not dry_run and not exists(outdir):
+        makedirs(outdir, exist_ok=True)
+
+    base_chunkdir="{}/{}".format(chunkdir, base_lang_code)
+    target_chunkdir="{}/{}".format(chunkdir, target_lang_code)
+    base_lang_chunks=None
+    target_lang_chunks=None
+    if chunkdir is not None:
+        if not exists(base_chunkdir):
+            makedirs(base_chunkdir, exist_ok=True)
+        if not exists(target_chunkdir):
+            makedirs(target_chunkdir, exist_ok=True)
+        # try to load any existing chunks
+        with instrumentation.stage("load_chunks"):
+            base_lang_chunks = load_audio_chunks(base_chunkdir, title, base_lang)
+            log.info("Loaded %s chunks in base lang %s from %s", len(base_lang_chunks), base_lang, base_chunkdir)
+            target_lang_chunks = load_audio_chunks(target_chunkdir, title, target_lang)
+            log.info("Loaded %s chunks in target lang %s from %s", len(target_lang_chunks), target_lang,
+                     target_chunkdir)
+
+    # Generate chunks in case we weren't able to load them
+    # the two tracks are independent until they're interleaved, so with --jobs they're chunked side by side
+    track_jobs = []
+    if base_lang_chunks is None or len(base_lang_chunks) == 0:
+        log.info("Creating chunks for base language")
+        track_jobs.append(("base", (base_audio, base_lang, base_lang_code, title, chunkdir,
+                                    base_audio_silence_threshold, base_offset, threshold_search, cache, streaming,
+                                    chunk_format)))
+    if target_lang_chunks is None or len(target_lang_chunks) == 0:
+        log.info("Creating chunks for target language")
+        track_jobs.append(("target", (target_audio, target_lang, target_lang_code, title, chunkdir,
+                                      target_audio_silence_threshold, target_offset, threshold_search, cache, streaming,
+                                      chunk_format)))
+
+    if jobs > 1 and len(track_jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(track_jobs))) as executor:
+            futures = [(track, executor.submit(instrumentation.run_profiled, chunk_track, *job_args))
+                       for track, job_args in track_jobs]
+            # collected in submission order, so output doesn't depend on which track finishes first
+            track_chunks = []
+            for track, future in futures:
+                chunks, worker_profile = future.result()
+                instrumentation.profile.merge(worker_profile)
+                track_chunks.append((track, chunks))
+    else:
+        track_chunks = [(track, chunk_track(*job_args)) for track, job_args in track_jobs]
+
+    for track, chunks in track_chunks:
+        if track == "base":
+            base_lang_chunks = chunks
+        else:
+            target_lang_chunks = chunks
+
+    plan, all_lang_chunks = interleave_tracks(base_lang_chunks, target_lang_chunks, title, outdir,
+                                              sync_points=sync_points, auto_sync=auto_sync, export=not dry_run,
+                                              export_jobs=export_jobs, reencode_all=reencode_all)
+    if dry_run:
+        lang_codes = {"base": base_lang_code, "target": target_lang_code}
+        print("Dry run, {} chunks would be exported in this order:".format(len(plan)))
+        print(" ".join("{}:{}".format(lang_codes[lang], idx) for lang, idx in plan))
+    return all_lang_chunks
+
+
+def interleave_tracks(base_lang_chunks, target_lang_chunks, title, outdir, sync_points=None, auto_sync=False,
+                      export=True, export_jobs=1, reencode_all=False):
+    # everything after chunking, returns the plan and the interleaved chunks
+    if auto_sync and not sync_points:
+        with instrumentation.stage("auto_sync"):
+            sync_points = find_sync_points(track_features(base_lang_chunks), track_features(target_lang_chunks))
+        log.info("Found sync points automatically, to reuse them pass: --sync-points %s", " ".join(sync_points))
+    sync_sections = create_sections_from_sync_points(sync_points, len(base_lang_chunks), len(target_lang_chunks))
+    # only needs chunk durations, chunks loaded from a chunk store don't read in any audio for this
+    with instrumentation.stage("interleave"):
+        plan = plan_sections([chunk.duration_seconds for chunk in base_lang_chunks],
+                             [chunk.duration_seconds for chunk in target_lang_chunks], sync_sections)
+    lang_chunks = {"base": base_lang_chunks, "target": target_lang_chunks}
+    all_lang_chunks = [lang_chunks[lang][idx] for lang, idx in plan]
+    if not export:
+        return plan, all_lang_chunks
+
+    with instrumentation.stage("final_export"):
+        if reencode_all:
+            export_each_audio_chunk(all_lang_chunks, outdir, title, base_lang_code, target_lang_code,
+                                    jobs=export_jobs)
+        else:
+            export_changed_audio_chunks(all_lang_chunks, outdir, title, base_lang_code, target_lang_code,
+                                        jobs=export_jobs)
+    return plan, all_lang_chunks
+
 def main():
     parser = argparse.ArgumentParser(description='Split two audio files into chunks by utterances and interleave corresponding chunks')
     parser.add_argument('--base-audio',  type=str,
@@ -273,8 +731,11 @@ def main():
                         help='Discard this number of chunks on the target audio file')
     parser.add_argument('--chunkdir', type=str,
                         help='Directory to output raw chunked audio from the two audio input tracks before any interleaving is done')
+    parser.add_argument('--chunk-format', type=str, choices=['store', 'mp3'], default='store',
+                        help='How raw chunks are saved to the chunkdir. "store" keeps all of a track\'s chunks in one '
+                             'uncompressed file that is quick to load, "mp3" writes each chunk to its own mp3 file')
     parser.add_argument('--outdir', type=str,
-                        help='Directory to output created files to')
+                        help='Directory to output created files to, not needed for a --dry-run')
     parser.add_argument('--title', type=str,
                         help='Title with which to label output files')
     # TODO: sync points has to be used with a specific, known silence level used for splitting
@@ -282,6 +743,38 @@ def main():
                         help='Silence level that will be used to split the base audio')
     parser.add_argument('--target-audio-silence-threshold', type=int, default=-37,
                         help='Silence level that will be used to split the target audio')
+    parser.add_argument('--threshold-search', type=str, choices=['step', 'index'], default='step',
+                        help='How to look for a silence threshold giving chunks of a good length. '
+                             '"step" re-splits the audio while nudging the threshold from the one given, '
+                             '"index" evaluates every threshold from a single pass over the audio')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to keep decoded audio in, so later runs over the same audio files skip decoding')
+    parser.add_argument('--cache-size-mb', type=int, default=4096,
+                        help='Size the audio cache is kept under, least recently used files are removed first')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of worker processes to use, with 2 or more the base and target audio are '
+                             'decoded and chunked at the same time')
+    parser.add_argument('--export-jobs', type=int, default=os.cpu_count(),
+                        help='Number of interleaved chunks to encode at the same time')
+    parser.add_argument('--reencode-all', action='store_true',
+                        help='Encode every interleaved chunk again, rather than keeping the output files of an earlier '
+                             'run that have the same audio in them')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Decode and split the audio a block at a time instead of loading whole files into memory. '
+                             'The silence thresholds are used as given, without searching for a better one')
+    parser.add_argument('--auto-sync', action='store_true',
+                        help='When no sync points are given, find some by aligning the chunks of the two tracks')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only work out the order chunks would be interleaved in and print it, without exporting '
+                             'anything. Quick to re-run with new sync points once chunks are saved in the chunkdir')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much detail to log, DEBUG shows every step of interleaving')
+    parser.add_argument('--profile', type=str,
+                        help='Write the time spent in each stage, and counts of threshold search attempts, chunks '
+                             'and ffmpeg processes run, to this json file')
+    parser.add_argument('--cprofile', type=str,
+                        help='Run under cProfile and write its stats to this file, for looking into with pstats')
     parser.add_argument('--sync-points', type=str, nargs='+',
                         help='List of pairs of chunk indexes, to force syncing at a specific point in the two audio tracks'
                              'Audio will be synced at the end of the specified chunks, '
@@ -289,76 +782,35 @@ def main():
                              'Specify each index pair as a separate argument, with the format: "<base_chunk_index>:<tgt_chunk_index>". '
                              'Sync points must be specified *in order*')
     args = parser.parse_args()
-
-    target_audio = args.target_audio
-    base_audio = args.base_audio
-
-    title = args.title
-    base_offset = args.base_offset
-    target_offset = args.target_offset
-    base_audio_silence_threshold = args.base_audio_silence_threshold
-    target_audio_silence_threshold = args.target_audio_silence_threshold
-    sync_points = args.sync_points
-
-    outdir = args.outdir
-    if not exists(outdir):
-        makedirs(outdir, exist_ok=True)
-
-    chunkdir = args.chunkdir
-    base_chunkdir="{}/{}".format(chunkdir, base_lang_code)
-    target_chunkdir="{}/{}".format(chunkdir, target_lang_code)
-    base_lang_chunks=None
-    target_lang_chunks=None
-    if chunkdir is not None:
-        if not exists(base_chunkdir):
-            makedirs(base_chunkdir, exist_ok=True)
-        if not exists(target_chunkdir):
-            makedirs(target_chunkdir, exist_ok=True)
-        # try to load any existing chunks
-        base_lang_chunks = load_audio_chunks(base_chunkdir, title, base_lang)
-        print("Loaded {} chunks in base lang {} from {}".format(len(base_lang_chunks), base_lang, base_chunkdir))
-        target_lang_chunks = load_audio_chunks(target_chunkdir, title, target_lang)
-        print("Loaded {} chunks in target lang {} from {}".format(len(target_lang_chunks), target_lang, target_chunkdir))
-
-    # Generate chunks in case we weren't able to load them
-    if base_lang_chunks is None or len(base_lang_chunks) == 0:
-        # TODO: can parallelise both by chapter and chunk generation in base/tgt
-        base_lang_audio_segment = AudioSegment.from_mp3(base_audio)
-        print("Creating chunks for base language")
-        base_lang_chunks = create_audio_chunks(base_lang_audio_segment, 5, 15, base_lang, initial_silence_thresh=base_audio_silence_threshold,
-                                               discard_initial_chunks=base_offset)
-        export_raw_audio_chunks(base_lang_chunks, chunkdir, title, base_lang_code)
-
-    if target_lang_chunks is None or len(target_lang_chunks) == 0:
-        tgt_lang_audio_segment = AudioSegment.from_mp3(target_audio)
-        print("Creating chunks for target language")
-        target_lang_chunks = create_audio_chunks(tgt_lang_audio_segment, 5, 15, target_lang, initial_silence_thresh=target_audio_silence_threshold,
-                                              discard_initial_chunks=target_offset)
-        export_raw_audio_chunks(target_lang_chunks, chunkdir, title, target_lang_code)
-
-    #
-    sync_sections = create_sections_from_sync_points(sync_points, len(base_lang_chunks), len(target_lang_chunks))
-    if sync_sections is None or len(sync_sections) == 0:
-        all_lang_chunks = interleave_matching_audio_segments(
-            base_lang_chunks, target_lang_chunks)
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    if args.outdir is None and not args.dry_run:
+        parser.error("--outdir is needed, unless it's a --dry-run")
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = AudioCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 * 1024)
+
+    run = partial(interleave_chapter, args.base_audio, args.target_audio, args.title, args.outdir,
+                  chunkdir=args.chunkdir, base_offset=args.base_offset, target_offset=args.target_offset,
+                  base_audio_silence_threshold=args.base_audio_silence_threshold,
+                  target_audio_silence_threshold=args.target_audio_silence_threshold,
+                  sync_points=args.sync_points, threshold_search=args.threshold_search, cache=cache,
+                  jobs=args.jobs, streaming=args.streaming, chunk_format=args.chunk_format,
+                  export_jobs=args.export_jobs, dry_run=args.dry_run, auto_sync=args.auto_sync,
+                  reencode_all=args.reencode_all)
+    if args.cprofile is not None:
+        # only sees this process, worker processes started by --jobs aren't included
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+        profiler.dump_stats(args.cprofile)
+        log.info("Wrote cProfile stats to %s", args.cprofile)
     else:
-        all_lang_chunks = []
-        print("{} sync points found, going to interleave {} sections in sequence", len(sync_points), len(sync_sections))
-        for i, section in enumerate(sync_sections):
-            print("Starting to interleave chunks for section {}, starting from {}:{}, finishing at {}:{}".format(
-                i,
-                section.base_start,section.tgt_start,
-                section.base_end,section.tgt_end))
-
-            all_lang_chunks += interleave_matching_audio_segments(
-                base_lang_chunks[section.base_start:section.base_end], target_lang_chunks[section.tgt_start:section.tgt_end])
-
-            print("Finished interleaving chunks for section {} (from {}:{} to {}:{})".format(
-                i,
-                section.base_start,section.tgt_start,
-                section.base_end,section.tgt_end))
-
-    export_each_audio_chunk(all_lang_chunks, outdir, title, base_lang_code, target_lang_code)
+        run()
+
+    if args.profile is not None:
+        instrumentation.profile.write(args.profile)
+        log.info("Wrote profile to %s", args.profile)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import makedirs
+from os.path import exists, getmtime
+
+import instrumentation
+import interleave
+from audio_cache import AudioCache
+from envelope import LoudnessEnvelope
+
+log = logging.getLogger(__name__)
+
+# settings a job can give, and what they are when it doesn't
+JOB_SETTINGS = {"base_offset": 0, "target_offset": 0, "base_audio_silence_threshold": -37,
+                "target_audio_silence_threshold": -37, "sync_points": None, "threshold_search": "step",
+                "auto_sync": False, "dry_run": False, "reencode_all": False}
+JOB_REQUIRED = ["base_audio", "target_audio", "title", "outdir"]
+
+
+class ResidentCache:
+    """
+    Decoded tracks and their chunks, kept in memory between jobs. The least recently used entries are
+    dropped once they add up to more than max_bytes. Each entry is only made once, even when several jobs
+    want it at the same time.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # [lock, number of gets holding or waiting for it] for each key being looked up, kept apart from the
+        # entries so dropping an entry can't hand out a second lock for a key while the first is in use
+        self._key_locks = {}
+
+    def get(self, key, create, size_of):
+        """The value for key, made with create() if it isn't there. Returns the value and whether it was cached"""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                        instrumentation.count("resident_cache_hits")
+                        return self._entries[key][0], True
+                instrumentation.count("resident_cache_misses")
+                value = create()
+                with self._lock:
+                    self._entries[key] = (value, size_of(value))
+                    self._evict()
+                return value, False
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    def _evict(self):
+        # the newest entry is kept even if it's bigger than max_bytes on its own
+        while len(self._entries) > 1 and self.total_bytes() > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            log.info("Dropping %s from memory", key[:2])
+
+    def total_bytes(self):
+        return sum(size for _, size in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.total_bytes(), "max_bytes": self.max_bytes}
+
+
+class Job:
+
+    def __init__(self, job_id, settings):
+        self.id = job_id
+        self.settings = settings
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.events = []
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def emit(self, message, **fields):
+        with self._changed:
+            self.events.append(dict(fields, time=time.time(), message=message))
+            self._changed.notify_all()
+
+    def set_status(self, status, result=None, error=None):
+        with self._changed:
+            self.status, self.result, self.error = status, result, error
+            self._changed.notify_all()
+
+    def wait_for_events(self, start, timeout=None):
+        """Events from index start on, waiting for some if there aren't any yet and the job is still going"""
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > start or self.finished, timeout)
+            return self.events[start:], self.finished
+
+    def to_dict(self):
+        return {"id": self.id, "status": self.status, "settings": self.settings, "result": self.result,
+                "error": self.error}
+
+
+class JobLogHandler(logging.Handler):
+    # passes log messages on to the job being run by the thread that logged them, as its progress
+    def __init__(self):
+        super().__init__(level=logging.INFO)
+        self.jobs_by_thread = {}
+
+    def emit(self, record):
+        job = self.jobs_by_thread.get(threading.get_ident())
+        if job is not None:
+            job.emit(record.getMessage(), level=record.levelname)
+
+
+class InterleaveService:
+    """
+    Runs interleaving jobs, keeping each track's decoded audio and chunks in memory for the jobs after it.
+    A job that only changes sync points just plans again and exports the chunks that changed.
+    """
+
+    def __init__(self, cache_bytes=4096 * 1024 * 1024, workers=2, export_jobs=1, audio_cache=None):
+        self.resident = ResidentCache(cache_bytes)
+        self.export_jobs = export_jobs
+        self.audio_cache = audio_cache
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # jobs writing to the same outdir would trip over each other's output manifest
+        self._outdir_locks = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._log_handler = JobLogHandler()
+        logging.getLogger().addHandler(self._log_handler)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        logging.getLogger().removeHandler(self._log_handler)
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("A job is a JSON object of settings")
+        missing = [field for field in JOB_REQUIRED if not request.get(field)]
+        if missing:
+            raise ValueError("Jobs need {}".format(", ".join(missing)))
+        unknown = set(request) - set(JOB_REQUIRED) - set(JOB_SETTINGS)
+        if unknown:
+            raise ValueError("Unknown job settings: {}".format(", ".join(sorted(unknown))))
+        settings = dict(JOB_SETTINGS, **request)
+        with self._lock:
+            job = Job(next(self._ids), settings)
+            self.jobs[job.id] = job
+        job.emit("Queued")
+        self._executor.submit(self._run, job)
+        return job
+
+    def track(self, path):
+        def decode():
+            audio_segment, envelope = interleave.decode_audio(path, self.audio_cache)
+            # measured once here, so every threshold tried later on is quick
+            return audio_segment, envelope or LoudnessEnvelope.from_segment(audio_segment)
+        return self.resident.get(("track", path, getmtime(path)), decode,
+                                 lambda track: len(track[0].raw_data) + track[1].cumulative_energy.nbytes)
+
+    def track_chunks(self, path, lang_title, silence_thresh, offset, threshold_search):
+        def chunk():
+            (audio_segment, envelope), _ = self.track(path)
+            with instrumentation.stage("threshold_search"):
+                return interleave.create_audio_chunks(audio_segment, 5, 15, lang_title,
+                                                      initial_silence_thresh=silence_thresh,
+                                                      discard_initial_chunks=offset,
+                                                      threshold_search=threshold_search, envelope=envelope)
+        key = ("chunks", path, getmtime(path), lang_title, silence_thresh, offset, threshold_search)
+        return self.resident.get(key, chunk, lambda chunks: sum(len(c.segment.raw_data) for c in chunks))
+
+    def _run(self, job):
+        self._log_handler.jobs_by_thread[threading.get_ident()] = job
+        job.set_status("running")
+        settings = job.settings
+        try:
+            tracks = {}
+            for track, lang_title in (("base", interleave.base_lang), ("target", interleave.target_lang)):
+                chunks, cached = self.track_chunks(settings["{}_audio".format(track)], lang_title,
+                                                   settings["{}_audio_silence_threshold".format(track)],
+                                                   settings["{}_offset".format(track)], settings["threshold_search"])
+                job.emit("{} chunks {}".format(len(chunks), "already in memory" if cached else "made"),
+                         track=track, chunks=len(chunks), cached=cached)
+                tracks[track] = chunks
+
+            outdir = settings["outdir"]
+            with self._lock:
+                outdir_lock = self._outdir_locks.setdefault(os.path.abspath(outdir), threading.Lock())
+            with outdir_lock:
+                if not exists(outdir):
+                    makedirs(outdir, exist_ok=True)
+                plan, _ = interleave.interleave_tracks(
+                    tracks["base"], tracks["target"], settings["title"], outdir, sync_points=settings["sync_points"],
+                    auto_sync=settings["auto_sync"], export=not settings["dry_run"], export_jobs=self.export_jobs,
+                    reencode_all=settings["reencode_all"])
+            job.set_status("done", result={"plan": [[lang, idx] for lang, idx in plan]})
+            job.emit("Done", chunks=len(plan))
+        except Exception as e:
+            log.exception("Job %s failed", job.id)
+            job.set_status("failed", error=str(e))
+            job.emit("Failed: {}".format(e))
+        finally:
+            self._log_handler.jobs_by_thread.pop(threading.get_ident(), None)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs                 submit a job, a JSON object of interleave.py's settings, e.g.
+                               {"base_audio": "en-1.mp3", "target_audio": "es-1.mp3", "title": "chapter-1",
+                                "outdir": "out/chapter-1", "sync_points": ["4:16"]}
+    GET  /jobs                 every job and its status
+    GET  /jobs/<id>            a job's status, and its plan once it's done
+    GET  /jobs/<id>/events     a job's progress, one JSON object per line, as it happens
+    GET  /status               what's held in memory and the time spent in each stage so far
+    """
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self, job_id):
+        job = self.server.service.jobs.get(int(job_id))
+        if job is None:
+            self._send_json(404, {"error": "No job {}".format(job_id)})
+        return job
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.server.service.submit(request)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        self._send_json(202, job.to_dict())
+
+    def do_GET(self):
+        service = self.server.service
+        m = re.match(r'^/jobs/([0-9]+)(/events)?$', self.path)
+        if self.path == "/jobs":
+            self._send_json(200, [job.to_dict() for job in list(service.jobs.values())])
+        elif self.path == "/status":
+            self._send_json(200, {"cache": service.resident.stats(), "profile": instrumentation.profile.to_dict()})
+        elif m and not m.group(2):
+            job = self._job(m.group(1))
+            if job is not None:
+                self._send_json(200, job.to_dict())
+        elif m:
+            job = self._job(m.group(1))
+            if job is not None:
+                self._stream_events(job)
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def _stream_events(self, job):
+        # no content length, the response ends when the connection is closed after the job finishes
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        sent = 0
+        finished = False
+        while not finished:
+            events, finished = job.wait_for_events(sent, timeout=1)
+            for event in events:
+                self.wfile.write((json.dumps(event) + "\n").encode())
+            self.wfile.flush()
+            sent += len(events)
+        self.wfile.write((json.dumps(job.to_dict()) + "\n").encode())
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def make_server(service, host="127.0.0.1", port=8765):
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep tracks decoded and chunked in memory, and interleave them '
+                                                 'for jobs sent over HTTP')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on, only this machine by default')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of jobs to run at the same time')
+    parser.add_argument('--export-jobs', type=int, default=os.cpu_count(),
+                        help='Number of interleaved chunks to encode at the same time, for each job')
+    parser.add_argument('--memory-mb', type=int, default=4096,
+                        help='Size the decoded tracks and chunks held in memory are kept under, least recently '
+                             'used ones are dropped first')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to keep decoded audio in, so tracks dropped from memory skip decoding too')
+    parser.add_argument('--cache-size-mb', type=int, default=4096,
+                        help='Size the audio cache is kept under, least recently used files are removed first')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much detail to log')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    audio_cache = None
+    if args.cache_dir is not None:
+        audio_cache = AudioCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 * 1024)
+    service = InterleaveService(cache_bytes=args.memory_mb * 1024 * 1024, workers=args.workers,
+                                export_jobs=args.export_jobs, audio_cache=audio_cache)
+    server = make_server(service, args.host, args.port)
+    log.info("Listening on http://%s:%s", args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == '__main__':
+    main()
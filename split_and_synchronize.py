@@ -1,30 +1,220 @@
-from google.cloud import speech
-from google.cloud.speech import enums
-from google.cloud.speech import types
+#!/usr/bin/env python3
+import abc
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
 from collections import Counter
+from os import makedirs
+from os.path import exists, join
 
-def transcribe_gcs(gcs_uri, language_code):
-    """Transcribes the audio file specified by the gcs_uri."""
-    client = speech.SpeechClient()
+import instrumentation
+import interleave
+from envelope import LoudnessEnvelope
 
-    audio = types.RecognitionAudio(uri=gcs_uri)
-    config = types.RecognitionConfig(
-        encoding=enums.RecognitionConfig.AudioEncoding.FLAC,
-        sample_rate_hertz=16000,
-        language_code=language_code,
-        enable_word_time_offsets=True)
+log = logging.getLogger(__name__)
 
-    operation = client.long_running_recognize(config, audio)
 
-    print('Waiting for operation to complete...')
-    response = operation.result(timeout=120)
+# a transcription is a dict, so it can go straight into the cache:
+# {"transcript": "...", "words": [{"word": "...", "start_seconds": 0.1, "end_seconds": 0.5}, ...]}
+# word times are from the start of the chunk that was transcribed
 
-    # Each result is for a consecutive portion of the audio. Iterate through
-    # them to get the transcripts for the entire audio file.
-    for result in response.results:
-        # The first alternative is the most likely one for this portion.
-        words = [w.word for w in result.alternatives[0].words]
-        word_counts = Counter(words)
-        print(word_counts)
+class Recognizer(abc.ABC):
+    """Speech to text backend. Subclasses implement recognize, which is awaited for one chunk at a time."""
+    name = None
 
-transcribe_gcs("gs://benjvi-audio-files/el-principito-capitulo-1.flac", "es-MX")
\ No newline at end of file
+    @abc.abstractmethod
+    async def recognize(self, segment, language_code):
+        pass
+
+
+class GoogleRecognizer(Recognizer):
+    name = "google"
+    # a synchronous request takes at most a minute of audio, longer chunks are sent in pieces
+    max_request_seconds = 55
+
+    def __init__(self):
+        # only needed for this backend, so it's not a requirement for the rest of the tools
+        from google.cloud import speech
+        from google.cloud.speech import enums, types
+        self._client = speech.SpeechClient()
+        self._enums = enums
+        self._types = types
+
+    def _recognize(self, segment, language_code):
+        # sent as raw 16 bit mono so there's no encoding step
+        segment = segment.set_channels(1).set_sample_width(2)
+        piece_ms = self.max_request_seconds * 1000
+        if len(segment) > piece_ms:
+            log.warning("Chunk of %.1f sec is longer than the %s sec a request can take, sending it in %s pieces",
+                        segment.duration_seconds, self.max_request_seconds, -(-len(segment) // piece_ms))
+        transcripts = []
+        words = []
+        for start_ms in range(0, len(segment), piece_ms):
+            transcription = self._recognize_piece(segment[start_ms:start_ms + piece_ms], language_code)
+            transcripts.append(transcription["transcript"])
+            # word times are from the start of the whole chunk
+            words += [dict(word, start_seconds=word["start_seconds"] + start_ms / 1000.0,
+                           end_seconds=word["end_seconds"] + start_ms / 1000.0)
+                      for word in transcription["words"]]
+        return {"transcript": " ".join(t for t in transcripts if t), "words": words}
+
+    def _recognize_piece(self, segment, language_code):
+        audio = self._types.RecognitionAudio(content=segment.raw_data)
+        config = self._types.RecognitionConfig(
+            encoding=self._enums.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=segment.frame_rate,
+            language_code=language_code,
+            enable_word_time_offsets=True)
+        response = self._client.recognize(config, audio)
+
+        transcripts = []
+        words = []
+        # each result is for a consecutive portion of the audio, the first alternative is the most likely one
+        for result in response.results:
+            alternative = result.alternatives[0]
+            transcripts.append(alternative.transcript)
+            words += [{"word": w.word,
+                       "start_seconds": w.start_time.seconds + w.start_time.nanos / 1e9,
+                       "end_seconds": w.end_time.seconds + w.end_time.nanos / 1e9}
+                      for w in alternative.words]
+        return {"transcript": " ".join(transcripts), "words": words}
+
+    async def recognize(self, segment, language_code):
+        # the client blocks, so requests are made from threads
+        return await asyncio.get_running_loop().run_in_executor(None, self._recognize, segment, language_code)
+
+
+class FakeRecognizer(Recognizer):
+    """
+    Stands in for a real backend offline: every stretch of sound in the chunk is a "word", named after a hash
+    of its audio, so the same audio always gets the same transcription. delay_seconds simulates request latency.
+    """
+    name = "fake"
+
+    def __init__(self, delay_seconds=0, silence_thresh=-37):
+        self.delay_seconds = delay_seconds
+        self.silence_thresh = silence_thresh
+        self.calls = 0
+
+    async def recognize(self, segment, language_code):
+        self.calls += 1
+        if self.delay_seconds:
+            await asyncio.sleep(self.delay_seconds)
+        envelope = LoudnessEnvelope.from_segment(segment)
+        words = []
+        for start, end in envelope.detect_nonsilent(min_silence_len=100, silence_thresh=self.silence_thresh):
+            digest = hashlib.sha256(segment[start:end].raw_data).hexdigest()[:6]
+            words.append({"word": "{}-{}".format(language_code, digest),
+                          "start_seconds": start / 1000.0, "end_seconds": end / 1000.0})
+        return {"transcript": " ".join(word["word"] for word in words), "words": words}
+
+
+RECOGNIZERS = {"google": GoogleRecognizer, "fake": FakeRecognizer}
+
+
+class TranscriptCache:
+    """Transcriptions kept on disk as json, by the audio, backend and language they're for."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not exists(cache_dir):
+            makedirs(cache_dir, exist_ok=True)
+
+    def key(self, chunk, recognizer, language_code):
+        digest = hashlib.sha256(interleave.chunk_content_key(chunk).encode())
+        digest.update("{} {}".format(recognizer.name, language_code).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        path = join(self.cache_dir, "{}.json".format(key))
+        if not exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, key, transcription):
+        path = join(self.cache_dir, "{}.json".format(key))
+        with open(path + ".tmp", "w") as f:
+            json.dump(transcription, f)
+        os.replace(path + ".tmp", path)
+
+
+async def transcribe_chunks_async(lang_chunks, recognizer, language_code, cache=None, concurrency=8):
+    # no more than concurrency requests are waited on at once, chunks with the same audio share one request
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = {}
+
+    async def transcribe(chunk, key):
+        if cache is not None:
+            cached = cache.load(key)
+            if cached is not None:
+                instrumentation.count("transcription_cache_hits")
+                return cached
+        async with semaphore:
+            instrumentation.count("transcription_requests")
+            transcription = await recognizer.recognize(chunk.segment, language_code)
+        if cache is not None:
+            cache.save(key, transcription)
+        return transcription
+
+    keys = [cache.key(chunk, recognizer, language_code) if cache is not None else interleave.chunk_content_key(chunk)
+            for chunk in lang_chunks]
+    for chunk, key in zip(lang_chunks, keys):
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(transcribe(chunk, key))
+    return [await tasks[key] for key in keys]
+
+
+def transcribe_chunks(lang_chunks, recognizer, language_code, cache=None, concurrency=8):
+    """Transcriptions of each of the chunks, in the same order"""
+    with instrumentation.stage("transcribe"):
+        return asyncio.run(transcribe_chunks_async(lang_chunks, recognizer, language_code,
+                                                   cache=cache, concurrency=concurrency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split an audio file into chunks and transcribe each of them, '
+                                                 'with the time of every word')
+    parser.add_argument('--audio', type=str, required=True,
+                        help='Audio file to transcribe')
+    parser.add_argument('--language-code', type=str, default='es-MX',
+                        help='Language of the audio, as a BCP-47 code')
+    parser.add_argument('--title', type=str, default='audio',
+                        help='Title with which to label the chunks')
+    parser.add_argument('--silence-threshold', type=int, default=-37,
+                        help='Silence level to start from when splitting the audio')
+    parser.add_argument('--backend', type=str, choices=sorted(RECOGNIZERS), default='google',
+                        help='Speech to text service to use, "fake" gives made up words without going online')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of chunks to have transcription requests in flight for at once')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to keep transcriptions in, so the same audio is never transcribed twice')
+    parser.add_argument('--output', type=str,
+                        help='JSON file to write the transcription of every chunk to')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much detail to log')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    audio_segment, envelope = interleave.decode_audio(args.audio)
+    lang_chunks = interleave.create_audio_chunks(audio_segment, 5, 15, args.title,
+                                                 initial_silence_thresh=args.silence_threshold,
+                                                 threshold_search="index", envelope=envelope)
+    cache = TranscriptCache(args.cache_dir) if args.cache_dir is not None else None
+    transcriptions = transcribe_chunks(lang_chunks, RECOGNIZERS[args.backend](), args.language_code,
+                                       cache=cache, concurrency=args.concurrency)
+
+    word_counts = Counter(word["word"] for transcription in transcriptions for word in transcription["words"])
+    log.info("Transcribed %s chunks, %s words, most common: %s", len(transcriptions),
+             sum(word_counts.values()), word_counts.most_common(10))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([dict(transcription, src_idx=chunk.src_idx)
+                       for chunk, transcription in zip(lang_chunks, transcriptions)], f, indent=2)
+
+if __name__ == '__main__':
+    main()
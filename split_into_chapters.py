@@ -1,6 +1,24 @@
 #!/usr/bin/env python
-from pydub import AudioSegment
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from os import makedirs
+from os.path import exists, splitext
+
+from pydub import AudioSegment
+from pydub.utils import mediainfo
+
+import instrumentation
+from envelope import LoudnessEnvelope
+from streaming import stream_pcm
+
+log = logging.getLogger(__name__)
 
 audiobook_filename = "the-little-prince-en.mp3"
 chapter_segments = [
@@ -12,29 +30,200 @@ chapter_segments = [
   (timedelta(minutes=21, seconds=30), timedelta(minutes=23, seconds=7)),
   (timedelta(minutes=23, seconds=7), timedelta(minutes=28, seconds=37)),
   (timedelta(minutes=28, seconds=37), timedelta(minutes=33, seconds=55)),
-  (timedelta(minutes=33, seconds=55), timedelta(minutes=37, seconds=7)), 
-  (timedelta(minutes=37, seconds=7), timedelta(minutes=45, seconds=42)), 
-  (timedelta(minutes=45, seconds=42), timedelta(minutes=47, seconds=51)), 
-  (timedelta(minutes=47, seconds=51), timedelta(minutes=49, seconds=11)), 
-  (timedelta(minutes=49, seconds=11), timedelta(minutes=54, seconds=55)), 
-  (timedelta(minutes=54, seconds=55), timedelta(minutes=59, seconds=51)), 
-  (timedelta(minutes=59, seconds=51), timedelta(hours=1, minutes=5, seconds=47)), 
-  (timedelta(hours=1, minutes=5, seconds=47), timedelta(hours=1, minutes=7, seconds=35)), 
-  (timedelta(hours=1, minutes=7, seconds=35), timedelta(hours=1, minutes=11, seconds=40)), 
-  (timedelta(hours=1, minutes=11, seconds=40), timedelta(hours=1, minutes=12, seconds=34)), 
-  (timedelta(hours=1, minutes=12, seconds=34), timedelta(hours=1, minutes=13, seconds=58)), 
-  (timedelta(hours=1, minutes=13, seconds=58), timedelta(hours=1, minutes=15, seconds=42)), 
-  (timedelta(hours=1, minutes=15, seconds=42), timedelta(hours=1, minutes=25, seconds=22)), 
-  (timedelta(hours=1, minutes=25, seconds=22), timedelta(hours=1, minutes=27, seconds=15)), 
-  (timedelta(hours=1, minutes=27, seconds=15), timedelta(hours=1, minutes=28, seconds=5)), 
-  (timedelta(hours=1, minutes=28, seconds=5), timedelta(hours=1, minutes=33, seconds=18)), 
-  (timedelta(hours=1, minutes=33, seconds=18), timedelta(hours=1, minutes=39, seconds=12)), 
-  (timedelta(hours=1, minutes=39, seconds=12), timedelta(hours=1, minutes=50, seconds=13)), 
-  (timedelta(hours=1, minutes=50, seconds=13), timedelta(hours=1, minutes=57, seconds=37)) 
+  (timedelta(minutes=33, seconds=55), timedelta(minutes=37, seconds=7)),
+  (timedelta(minutes=37, seconds=7), timedelta(minutes=45, seconds=42)),
+  (timedelta(minutes=45, seconds=42), timedelta(minutes=47, seconds=51)),
+  (timedelta(minutes=47, seconds=51), timedelta(minutes=49, seconds=11)),
+  (timedelta(minutes=49, seconds=11), timedelta(minutes=54, seconds=55)),
+  (timedelta(minutes=54, seconds=55), timedelta(minutes=59, seconds=51)),
+  (timedelta(minutes=59, seconds=51), timedelta(hours=1, minutes=5, seconds=47)),
+  (timedelta(hours=1, minutes=5, seconds=47), timedelta(hours=1, minutes=7, seconds=35)),
+  (timedelta(hours=1, minutes=7, seconds=35), timedelta(hours=1, minutes=11, seconds=40)),
+  (timedelta(hours=1, minutes=11, seconds=40), timedelta(hours=1, minutes=12, seconds=34)),
+  (timedelta(hours=1, minutes=12, seconds=34), timedelta(hours=1, minutes=13, seconds=58)),
+  (timedelta(hours=1, minutes=13, seconds=58), timedelta(hours=1, minutes=15, seconds=42)),
+  (timedelta(hours=1, minutes=15, seconds=42), timedelta(hours=1, minutes=25, seconds=22)),
+  (timedelta(hours=1, minutes=25, seconds=22), timedelta(hours=1, minutes=27, seconds=15)),
+  (timedelta(hours=1, minutes=27, seconds=15), timedelta(hours=1, minutes=28, seconds=5)),
+  (timedelta(hours=1, minutes=28, seconds=5), timedelta(hours=1, minutes=33, seconds=18)),
+  (timedelta(hours=1, minutes=33, seconds=18), timedelta(hours=1, minutes=39, seconds=12)),
+  (timedelta(hours=1, minutes=39, seconds=12), timedelta(hours=1, minutes=50, seconds=13)),
+  (timedelta(hours=1, minutes=50, seconds=13), timedelta(hours=1, minutes=57, seconds=37))
 ]
 
-audiobook = AudioSegment.from_mp3("{}".format(audiobook_filename))
+# chapters are (start, end) in seconds from here on, end is None for "to the end of the audiobook"
+
+def parse_cue(text):
+    # cue sheet times are mm:ss:ff, with 75 frames a second
+    starts = []
+    for minutes, seconds, frames in re.findall(r'^\s*INDEX\s+01\s+(\d+):(\d+):(\d+)', text, re.MULTILINE):
+        starts.append(int(minutes) * 60 + int(seconds) + int(frames) / 75.0)
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def parse_boundaries_json(boundaries):
+    # either [[start, end], ...] or [{"start": .., "end": ..}, ...], a missing end is the next chapter's start
+    chapters = [(b["start"], b.get("end")) if isinstance(b, dict) else (b[0], b[1] if len(b) > 1 else None)
+                for b in boundaries]
+    return [(start, end if end is not None else (chapters[i + 1][0] if i + 1 < len(chapters) else None))
+            for i, (start, end) in enumerate(chapters)]
+
+
+def load_boundaries(path):
+    with open(path) as f:
+        text = f.read()
+    if splitext(path)[1].lower() == ".cue":
+        return parse_cue(text)
+    return parse_boundaries_json(json.loads(text))
+
+
+def detect_chapters(envelope, min_silence_len=3000, silence_thresh=-50, min_chapter_len=60, chapter_count=None):
+    """
+    Chapter boundaries from the long silences between them, cutting in the middle of each silence.
+    With chapter_count the longest silences are used, otherwise every one, as long as no chapter comes out
+    shorter than min_chapter_len seconds.
+    """
+    silences = envelope.detect_silence(min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+    length = envelope.length_ms / 1000.0
+    candidates = sorted(silences, key=lambda silence: silence[0] - silence[1])
+    cuts = []
+    for silence_start, silence_end in candidates:
+        if chapter_count is not None and len(cuts) >= chapter_count - 1:
+            break
+        cut = (silence_start + silence_end) / 2000.0
+        if all(abs(cut - other) >= min_chapter_len for other in [0, length] + cuts):
+            cuts.append(cut)
+    starts = [0.0] + sorted(cuts)
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def measure_envelope(path, frame_rate=8000, block_ms=60000):
+    # a low sample rate is plenty to find silences minutes apart. the audio is measured as it's decoded,
+    # only the envelope is kept
+    return LoudnessEnvelope.from_blocks(stream_pcm(path, frame_rate, 1, block_ms=block_ms), frame_rate, 1, 2)
+
+
+def chapter_files(chapters, outdir, format, album, artist, title_prefix):
+    return [("{}/chapter-{}.{}".format(outdir, idx, format),
+             {"album": album, "artist": artist, "title": "{}-{}".format(title_prefix, idx)})
+            for idx, _ in enumerate(chapters, start=1)]
+
+
+def _metadata_args(tags):
+    args = []
+    for key, value in tags.items():
+        args.extend(["-metadata", "{}={}".format(key, value)])
+    return args
+
+
+def _run_ffmpeg(command):
+    instrumentation.count("ffmpeg_processes")
+    # chapters are encoded by several at once, none of them may read from the terminal
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg returned error code {}\n\n{}".format(
+            result.returncode, result.stderr.decode(errors="replace")))
+
+
+def copy_chapters(path, chapters, files):
+    # the audiobook is read once and every chapter written from it by the same ffmpeg, without decoding it.
+    # cuts land on the nearest frame of the compressed audio (26ms for mp3)
+    command = [AudioSegment.converter, "-y", "-v", "error", "-i", path]
+    for (start, end), (out_path, tags) in zip(chapters, files):
+        command.extend(["-map", "0:a", "-ss", str(start)])
+        if end is not None:
+            command.extend(["-to", str(end)])
+        command.extend(["-c", "copy", "-map_metadata", "-1"] + _metadata_args(tags) + [out_path])
+    _run_ffmpeg(command)
+
+
+def encode_chapter(path, start, end, out_path, tags):
+    command = [AudioSegment.converter, "-y", "-v", "error", "-ss", str(start)]
+    if end is not None:
+        command.extend(["-t", str(end - start)])
+    command.extend(["-i", path, "-map", "0:a", "-map_metadata", "-1"] + _metadata_args(tags) + [out_path])
+    _run_ffmpeg(command)
+
+
+def can_copy(path, format):
+    # stream copy only works when the chapters are to be in the codec the audiobook already uses
+    return mediainfo(path).get("codec_name") == {"m4a": "aac"}.get(format, format)
+
+
+def split_chapters(path, chapters, files, reencode=False, jobs=None):
+    if not reencode and can_copy(path, splitext(files[0][0])[1][1:]):
+        try:
+            with instrumentation.stage("copy_chapters"):
+                copy_chapters(path, chapters, files)
+            return "copy"
+        except RuntimeError as e:
+            log.warning("Couldn't split without re-encoding, re-encoding instead: %s", e)
+    # each chapter is encoded by its own ffmpeg, seeking straight to its start
+    with instrumentation.stage("encode_chapters"), ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = [executor.submit(encode_chapter, path, start, end, out_path, tags)
+                   for (start, end), (out_path, tags) in zip(chapters, files)]
+        for future in futures:
+            future.result()
+    return "encode"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split an audiobook into a file per chapter')
+    parser.add_argument('--audiobook', type=str, default=audiobook_filename,
+                        help='Audiobook to split')
+    parser.add_argument('--outdir', type=str, default='the-little-prince',
+                        help='Directory to write chapter files to')
+    parser.add_argument('--boundaries', type=str,
+                        help='Cue sheet, or JSON list of [start, end] seconds, giving where each chapter is. '
+                             'Without this or --detect the chapters of The Little Prince are used')
+    parser.add_argument('--detect', action='store_true',
+                        help='Find chapters from long silences in the audiobook')
+    parser.add_argument('--chapters', type=int,
+                        help='With --detect, how many chapters there are, the longest silences are used to split them')
+    parser.add_argument('--min-silence-len', type=int, default=3000,
+                        help='With --detect, shortest silence in ms that can be between chapters')
+    parser.add_argument('--silence-threshold', type=int, default=-50,
+                        help='With --detect, the level in dBFS below which audio counts as silence')
+    parser.add_argument('--min-chapter-len', type=float, default=60,
+                        help='With --detect, shortest chapter in seconds')
+    parser.add_argument('--format', type=str, default='mp3',
+                        help='Format of the chapter files')
+    parser.add_argument('--album', type=str, default='The Little Prince')
+    parser.add_argument('--artist', type=str, default='bv')
+    parser.add_argument('--title-prefix', type=str, default='the-little-prince-ch',
+                        help='Chapter titles are this followed by the chapter number')
+    parser.add_argument('--reencode', action='store_true',
+                        help='Always decode and encode the chapters, rather than copying the audio where possible')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='Number of chapters to encode at the same time when re-encoding')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='How much detail to log')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    if args.boundaries is not None:
+        chapters = load_boundaries(args.boundaries)
+    elif args.detect:
+        with instrumentation.stage("detect_chapters"):
+            chapters = detect_chapters(measure_envelope(args.audiobook), min_silence_len=args.min_silence_len,
+                                       silence_thresh=args.silence_threshold, min_chapter_len=args.min_chapter_len,
+                                       chapter_count=args.chapters)
+    else:
+        chapters = [(start.total_seconds(), end.total_seconds()) for start, end in chapter_segments]
+    log.info("Splitting %s into %s chapters", args.audiobook, len(chapters))
+    for idx, (start, end) in enumerate(chapters, start=1):
+        log.debug("Chapter %s: %s - %s", idx, timedelta(seconds=start), "end" if end is None else timedelta(seconds=end))
+    if not chapters:
+        log.error("No chapters to split")
+        sys.exit(1)
+
+    if not exists(args.outdir):
+        makedirs(args.outdir, exist_ok=True)
+    files = chapter_files(chapters, args.outdir, args.format, args.album, args.artist, args.title_prefix)
+    method = split_chapters(args.audiobook, chapters, files, reencode=args.reencode, jobs=args.jobs)
+    log.info("Wrote %s chapters to %s (%s)", len(files), args.outdir,
+             "audio copied as it is" if method == "copy" else "re-encoded")
 
-for idx, segment in enumerate(chapter_segments, start=1):
-  chapter = audiobook[segment[0].total_seconds()*1000:segment[1].total_seconds()*1000]
-  chapter.export("the-little-prince/chapter-{}.mp3".format(idx), format="mp3", tags={"album": "The Little Prince", "artist": "bv", "title": "the-little-prince-ch-{}".format(idx)}) 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import subprocess
+import threading
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import db_to_float, mediainfo
+
+import instrumentation
+from envelope import SAMPLE_DTYPES
+
+
+def probe_audio(path):
+    instrumentation.count("ffmpeg_processes")
+    info = mediainfo(path)
+    return int(info["sample_rate"]), int(info["channels"])
+
+
+def stream_pcm(path, frame_rate, channels, block_ms=10000):
+    """
+    Decodes the audio file at path with ffmpeg, yielding 16 bit samples in blocks of block_ms, so the
+    whole file never has to be held in memory.
+    """
+    command = [AudioSegment.converter, "-v", "error", "-i", path,
+               "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(frame_rate), "-ac", str(channels), "-"]
+    block_bytes = max(1, frame_rate * block_ms // 1000) * channels * 2
+    instrumentation.count("ffmpeg_processes")
+    # with --jobs both tracks are decoded at once, neither may read from the terminal
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # read alongside the audio, so a lot of error output can't fill the pipe and stall ffmpeg
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data, dtype=np.int16)
+    finally:
+        process.stdout.close()
+        process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+    # only reached when all the audio was read, otherwise ffmpeg may have been stopped on purpose
+    if process.returncode != 0:
+        raise CouldntDecodeError("Decoding {} failed. ffmpeg returned error code: {}\n\n{}".format(
+            path, process.returncode, b"".join(stderr).decode(errors="replace")))
+
+
+class StreamingSplitter:
+    """
+    Splits audio on silence as it arrives, block by block, giving the same chunks as
+    envelope.split_on_silence would for the whole audio at once.
+
+    Only the audio of the chunk currently being built (plus the silence that may be kept around it) is
+    held on to, so memory doesn't grow with the length of the audio. Feed it blocks of interleaved samples
+    and it returns the chunks completed so far, call finish() at the end of the audio for the rest.
+    """
+
+    def __init__(self, frame_rate, channels, sample_width=2, min_silence_len=1000, silence_thresh=-16,
+                 keep_silence=100):
+        if isinstance(keep_silence, bool):
+            # keeping all the silence means knowing how long the audio is before any chunk can be returned
+            raise ValueError("keep_silence must be given in ms when streaming")
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.min_silence_len = min_silence_len
+        self.keep_silence = keep_silence
+        self._thresh = db_to_float(silence_thresh) * (2 ** (sample_width * 8)) / 2
+        self._acc_dtype = np.float64 if sample_width == 4 else np.int64
+
+        # samples received so far, from frame _buffer_start onwards
+        self._frames = 0
+        self._buffer = np.zeros(0, dtype=SAMPLE_DTYPES[sample_width])
+        self._buffer_start = 0
+        # cumulative energy at each millisecond boundary from _cumulative_start up to _ms_done
+        self._cumulative = np.zeros(1, dtype=self._acc_dtype)
+        self._cumulative_start = 0
+        self._ms_done = 0
+        self._next_window = 0
+        # first and last start of the silent windows making up the silent range we're in the middle of
+        self._open_silence = None
+        self._silence_end = 0
+        # whether the nonsilent range before the open silence has already been queued up
+        self._silence_start_done = False
+        # nonsilent [start, end] ranges that haven't been turned into chunks yet
+        self._nonsilent = []
+        self._next_chunk_start = None
+        self._length_ms = None
+
+    def _frame_of(self, ms):
+        return (np.asarray(ms) * (self.frame_rate / 1000.0)).astype(np.int64)
+
+    def _samples(self, start_frame, end_frame):
+        return self._buffer[(start_frame - self._buffer_start) * self.channels:
+                            (end_frame - self._buffer_start) * self.channels]
+
+    def feed(self, samples):
+        self._buffer = np.concatenate((self._buffer, samples))
+        self._frames += len(samples) // self.channels
+        # never look at a millisecond that could end up past the end of the audio
+        return self._advance(self._frames * 1000 // self.frame_rate)
+
+    def finish(self):
+        self._length_ms = round(1000 * (self._frames / self.frame_rate))
+        return self._advance(self._length_ms)
+
+    def _advance(self, ms_done):
+        final = self._length_ms is not None
+        if ms_done > self._ms_done:
+            frame_bounds = np.minimum(self._frame_of(np.arange(self._ms_done, ms_done + 1)), self._frames)
+            block = self._samples(frame_bounds[0], frame_bounds[-1]).astype(self._acc_dtype)
+            block *= block
+            block_cumulative = np.concatenate(([0], np.cumsum(block)))
+            new_cumulative = self._cumulative[-1] + block_cumulative[(frame_bounds - frame_bounds[0]) * self.channels]
+            self._cumulative = np.concatenate((self._cumulative, new_cumulative[1:]))
+            self._ms_done = ms_done
+
+        last_window = ms_done - self.min_silence_len
+        if last_window >= self._next_window:
+            windows = np.arange(self._next_window, last_window + 1)
+            energy = (self._cumulative[windows + self.min_silence_len - self._cumulative_start] -
+                      self._cumulative[windows - self._cumulative_start]).astype(np.float64)
+            # windows running over the end of the data are padded with silence, as pydub does
+            sample_count = (self._frame_of(windows + self.min_silence_len) - self._frame_of(windows)) * self.channels
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rms = np.floor(np.sqrt(energy / sample_count))
+            rms[sample_count == 0] = 0
+            self._add_silent_windows(windows[rms <= self._thresh])
+            self._next_window = last_window + 1
+
+        # once the chunk after the open silence can't start before the chunk ahead of it ends, the chunk ahead
+        # is complete. it's let go of straight away, so audio in the middle of a long silence isn't kept
+        if self._open_silence is not None and not self._silence_start_done:
+            silence_start, last_silent_window = self._open_silence
+            if last_silent_window + self.min_silence_len - self.keep_silence >= silence_start + self.keep_silence:
+                self._add_nonsilent_before_silence()
+                self._silence_start_done = True
+
+        # once a whole window has passed since the last silent one, the silent range can't grow any more
+        if self._open_silence is not None and (final or self._next_window - 1 >= self._open_silence[1] + self.min_silence_len):
+            self._close_silence()
+        if final and self._silence_end != self._length_ms:
+            self._nonsilent.append([self._silence_end, self._length_ms])
+
+        chunks = []
+        while len(self._nonsilent) > 1 or ((final or self._silence_start_done) and self._nonsilent):
+            chunks.append(self._next_chunk())
+        self._trim()
+        return chunks
+
+    def _add_silent_windows(self, silence_starts):
+        if len(silence_starts) == 0:
+            return
+        # split the silent windows wherever they're more than a window apart, same as pydub
+        gaps = np.flatnonzero(np.diff(silence_starts) > self.min_silence_len)
+        group_starts = silence_starts[np.concatenate(([0], gaps + 1))].tolist()
+        group_ends = silence_starts[np.concatenate((gaps, [len(silence_starts) - 1]))].tolist()
+        for group_start, group_end in zip(group_starts, group_ends):
+            if self._open_silence is not None and group_start - self._open_silence[1] <= self.min_silence_len:
+                self._open_silence[1] = group_end
+                continue
+            if self._open_silence is not None:
+                self._close_silence()
+            self._open_silence = [group_start, group_end]
+
+    def _add_nonsilent_before_silence(self):
+        silence_start = self._open_silence[0]
+        if not (self._silence_end == 0 and silence_start == 0):
+            self._nonsilent.append([self._silence_end, silence_start])
+
+    def _close_silence(self):
+        if not self._silence_start_done:
+            self._add_nonsilent_before_silence()
+        self._silence_start_done = False
+        self._silence_end = self._open_silence[1] + self.min_silence_len
+        self._open_silence = None
+
+    def _next_chunk(self):
+        start, end = self._nonsilent.pop(0)
+        start = self._next_chunk_start if self._next_chunk_start is not None else start - self.keep_silence
+        end = end + self.keep_silence
+        self._next_chunk_start = None
+        if self._nonsilent:
+            # share any overlapping kept silence evenly with the next chunk
+            next_start = self._nonsilent[0][0] - self.keep_silence
+            if next_start < end:
+                end = (end + next_start) // 2
+                self._next_chunk_start = end
+        start = max(start, 0)
+        if self._length_ms is not None:
+            end = min(end, self._length_ms)
+
+        start_frame, end_frame = self._frame_of([start, end]).tolist()
+        samples = self._samples(start_frame, min(end_frame, self._frames))
+        missing = (end_frame - start_frame) * self.channels - len(samples)
+        if missing:
+            samples = np.concatenate((samples, np.zeros(missing, dtype=samples.dtype)))
+        return AudioSegment(samples.tobytes(), sample_width=self.sample_width, frame_rate=self.frame_rate,
+                            channels=self.channels)
+
+    def _trim(self):
+        # forget audio before the start of the next chunk, and energy before the next window
+        if self._next_chunk_start is not None:
+            keep_from_ms = self._next_chunk_start
+        elif self._nonsilent:
+            keep_from_ms = self._nonsilent[0][0] - self.keep_silence
+        elif self._silence_start_done:
+            # the next chunk starts no earlier than keep_silence before the end of the silence so far
+            keep_from_ms = self._open_silence[1] + self.min_silence_len - self.keep_silence
+        else:
+            keep_from_ms = self._silence_end - self.keep_silence
+        keep_from_frame = min(int(self._frame_of(max(keep_from_ms, 0))), int(self._frame_of(self._ms_done)), self._frames)
+        if keep_from_frame > self._buffer_start:
+            self._buffer = self._buffer[(keep_from_frame - self._buffer_start) * self.channels:].copy()
+            self._buffer_start = keep_from_frame
+        if self._next_window > self._cumulative_start:
+            self._cumulative = self._cumulative[self._next_window - self._cumulative_start:]
+            self._cumulative_start = self._next_window
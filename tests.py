@@ -1,5 +1,36 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+import numpy as np
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError, CouldntEncodeError
+from pydub.silence import split_on_silence as pydub_split_on_silence
 import interleave
+import interleave_service
+import envelope
+import autosync
+import batch_interleave
+import chunk_store
+import convert_audio
+import instrumentation
+import split_and_synchronize
+import split_into_chapters
+from fixtures import make_bursts, synthetic_pair, synthetic_track, three_utterances, uneven_levels
+from streaming import StreamingSplitter, stream_pcm
+from audio_cache import AudioCache
+
+
+def _load_from_shared_cache(args):
+    cache_dir, paths, worker = args
+    cache = AudioCache(cache_dir, max_bytes=100000)
+    return [len(cache.load(paths[(i * 7 + worker) % len(paths)], format="wav")[0]) for i in range(40)]
 
 
 class InterleavingTests(unittest.TestCase):
@@ -11,5 +42,727 @@ class InterleavingTests(unittest.TestCase):
         sections = interleave.create_sections_from_sync_points(["4:16","51:101","99:212","140:297"], 183, 373)
         self.assertEqual(len(sections), 5)
 
+    def test_plan_interleave(self):
+        plan = interleave.plan_interleave([4.0, 6.5, 3.2, 8.0, 5.5], [5.1, 2.2, 7.3, 6.0, 4.4, 3.9])
+        self.assertEqual(plan, [("target", 0), ("base", 0), ("target", 1), ("base", 1), ("target", 2), ("base", 2),
+                                ("target", 3), ("base", 3), ("target", 4), ("target", 5), ("base", 4)])
+
+    def test_plan_sections_indexes_whole_tracks(self):
+        sections = interleave.create_sections_from_sync_points(["1:2"], 5, 6)
+        plan = interleave.plan_sections([4.0, 6.5, 3.2, 8.0, 5.5], [5.1, 2.2, 7.3, 6.0, 4.4, 3.9], sections)
+        self.assertEqual(sorted(plan), sorted([("base", i) for i in range(5)] + [("target", i) for i in range(6)]))
+        # nothing after the sync point is played before everything up to it
+        self.assertEqual(sorted(plan[:5]), [("base", 0), ("base", 1), ("target", 0), ("target", 1), ("target", 2)])
+
+
+    def test_parallel_chunking_matches_sequential(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            base_audio, target_audio = os.path.join(tmpdir, "base.wav"), os.path.join(tmpdir, "target.wav")
+            synthetic_track(60, seed=1)[0].export(base_audio, format="wav")
+            synthetic_track(60, seed=2, stretch=1.2)[0].export(target_audio, format="wav")
+            results = {}
+            # worker processes are forked, so they see the patched decode as well
+            with mock.patch.object(interleave, "decode_audio", lambda path, cache=None: (AudioSegment.from_wav(path), None)), \
+                    mock.patch("builtins.print"):
+                for jobs in (1, 4):
+                    chunks = interleave.interleave_chapter(base_audio, target_audio, "chapter-1",
+                                                           os.path.join(tmpdir, "out-{}".format(jobs)),
+                                                           chunkdir=os.path.join(tmpdir, "chunks-{}".format(jobs)),
+                                                           base_offset=1, jobs=jobs, dry_run=True)
+                    results[jobs] = [(c.lang_title, c.src_idx, c.segment.raw_data) for c in chunks]
+            self.assertGreater(len(results[1]), 10)
+            self.assertEqual(results[4], results[1])
+
+
+class AutoSyncTests(unittest.TestCase):
+    def test_banded_dtw_matches_full_dtw(self):
+        rng = np.random.default_rng(0)
+        for n, m in ((1, 1), (1, 6), (7, 3), (12, 12), (9, 14)):
+            cost = rng.random((n, m))
+            total = np.full((n + 1, m + 1), np.inf)
+            total[0, 0] = 0
+            for i in range(n):
+                for j in range(m):
+                    total[i + 1, j + 1] = cost[i, j] + min(total[i, j + 1], total[i + 1, j], total[i, j])
+            path = autosync.banded_dtw(lambda i, js: cost[i, js], n, m, band=max(n, m))
+            self.assertAlmostEqual(sum(cost[i, j] for i, j in path), total[n, m])
+
+    def test_band_does_not_grow_with_the_number_of_chunks(self):
+        rng = np.random.default_rng(3)
+        for n in (50, 5000):
+            durations = rng.uniform(2, 9, n)
+            base_starts = np.concatenate(([0], np.cumsum(durations)[:-1])) / durations.sum()
+            # the target splits every 25th chunk in two
+            tgt_durations = np.concatenate([[d / 2, d / 2] if i % 25 == 0 else [d] for i, d in enumerate(durations)])
+            tgt_starts = np.concatenate(([0], np.cumsum(tgt_durations)[:-1])) / tgt_durations.sum()
+            self.assertLessEqual(autosync.timing_band(base_starts, tgt_starts), 12)
+
+    def test_sync_points_follow_a_split_chunk(self):
+        rng = np.random.default_rng(5)
+        speech, pauses = rng.integers(2000, 9000, 30), rng.integers(300, 900, 30)
+        base = [interleave.LangChunk(make_bursts([(p, 0), (s, 8000), (p, 0)], seed=i), "English")
+                for i, (s, p) in enumerate(zip(speech, pauses))]
+        # the target reads more slowly, and has an extra chunk after the 10th
+        target = [interleave.LangChunk(make_bursts([(int(p * 1.1), 0), (int(s * 1.3), 8000), (int(p * 1.1), 0)],
+                                                   seed=100 + i), "Spanish")
+                  for i, (s, p) in enumerate(zip(speech, pauses))]
+        target.insert(10, interleave.LangChunk(make_bursts([(300, 0), (2000, 8000), (300, 0)]), "Spanish"))
+
+        sync_points = autosync.find_sync_points(autosync.track_features(base), autosync.track_features(target))
+        self.assertTrue(sync_points)
+        for point in sync_points:
+            base_idx, tgt_idx = map(int, point.split(":"))
+            self.assertEqual(tgt_idx, base_idx if base_idx < 10 else base_idx + 1)
+        self.assertEqual(len(interleave.create_sections_from_sync_points(sync_points, len(base), len(target))),
+                         len(sync_points) + 1)
+
+
+    def test_sync_points_skip_chunks_only_one_track_has(self):
+        (base_audio, _), (target_audio, _) = synthetic_pair(600, seed=3)
+        base = autosync.track_features(interleave.create_audio_chunks(base_audio, 5, 15, "English",
+                                                                      threshold_search="index"))
+        target = autosync.track_features(interleave.create_audio_chunks(target_audio, 5, 15, "Spanish",
+                                                                        threshold_search="index"))
+        # chunk i of one is chunk i of the other, the target has a couple more at the end
+        self.assertGreater(len(target), len(base))
+        # and then an intro of 3 more chunks at the start of the target, or of the base
+        for base_features, tgt_features, tgt_offset in ((base, target, 0), (base[3:], target, 3),
+                                                        (base, target[3:], -3)):
+            sync_points = autosync.find_sync_points(base_features, tgt_features)
+            self.assertGreater(len(sync_points), 4)
+            for point in sync_points:
+                base_idx, tgt_idx = map(int, point.split(":"))
+                self.assertEqual(tgt_idx, base_idx + tgt_offset, point)
+
+
+class ExportTests(unittest.TestCase):
+    def test_assemble_audio_matches_adding_segments(self):
+        segments = [make_bursts([(300, 8000)], seed=i, frame_rate=11025, channels=1 + i % 2) for i in range(5)]
+        expected = AudioSegment.empty()
+        for segment in segments:
+            expected += segment
+        expected += AudioSegment.silent(duration=3000)
+        actual = interleave.assemble_audio(segments, trailing_silence_ms=3000)
+        self.assertEqual((actual.frame_rate, actual.channels, actual.sample_width),
+                         (expected.frame_rate, expected.channels, expected.sample_width))
+        self.assertEqual(actual.raw_data, expected.raw_data)
+
+    def test_stream_export_reports_ffmpeg_errors(self):
+        audio = make_bursts([(3000, 8000)] * 20)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def fake_ffmpeg(name, script):
+                path = os.path.join(tmpdir, name)
+                with open(path, "w") as f:
+                    f.write("#!/bin/sh\n" + script)
+                os.chmod(path, 0o755)
+                return path
+
+            # lots of output while the audio is still being written mustn't hold either side up
+            chatty = fake_ffmpeg("chatty", "head -c 1000000 /dev/zero >&2\ncat > /dev/null\n")
+            with mock.patch.object(AudioSegment, "converter", chatty):
+                interleave.stream_export([audio], os.path.join(tmpdir, "out.mp3"), audio.frame_rate, audio.channels)
+
+            failing = fake_ffmpeg("failing", "echo 'Unknown encoder' >&2\nexit 1\n")
+            with mock.patch.object(AudioSegment, "converter", failing):
+                with self.assertRaisesRegex(CouldntEncodeError, "Unknown encoder"):
+                    interleave.stream_export([audio], os.path.join(tmpdir, "out.mp3"), audio.frame_rate,
+                                             audio.channels)
+
+    def test_export_each_audio_chunk_names_and_tags(self):
+        chunks = [interleave.LangChunk(make_bursts([(100, 8000)], seed=i), lang, src_idx=i)
+                  for i, lang in enumerate(["Spanish", "English"] * 6)]
+        exported = {}
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(interleave, "export_audio_chunk",
+                                  lambda chunk, path, tags: exported.__setitem__(path, (chunk, tags))):
+            interleave.export_each_audio_chunk(chunks, tmpdir, "chapter-1", "EN", "ES", jobs=4)
+        self.assertEqual(len(exported), 12)
+        chunk, tags = exported["{}/03-Spanish-2.mp3".format(tmpdir)]
+        self.assertIs(chunk, chunks[2])
+        self.assertEqual(tags, {"album": "chapter-1-EN-ES", "artist": "bv-interleaved-audio",
+                                "title": "03-chapter-1-Spanish-2", "track": "03"})
+
+    def test_export_changed_audio_chunks_reuses_earlier_output(self):
+        chunks = [interleave.LangChunk(make_bursts([(100, 8000)], seed=i), lang, src_idx=i)
+                  for i, lang in enumerate(["Spanish", "English"] * 3)]
+        encoded, retagged = [], []
+
+        def fake_export(chunk, path, tags):
+            encoded.append(os.path.basename(path))
+            with open(path, "w") as f:
+                json.dump(dict(tags, content=interleave.chunk_content_key(chunk)), f)
+
+        def fake_retag(src_path, path, tags):
+            retagged.append(os.path.basename(path))
+            with open(src_path) as f:
+                content = json.load(f)["content"]
+            with open(path, "w") as f:
+                json.dump(dict(tags, content=content), f)
+
+        with mock.patch.object(interleave, "export_audio_chunk", fake_export), \
+                mock.patch.object(interleave, "retag_audio_chunk", fake_retag), \
+                tempfile.TemporaryDirectory() as tmpdir:
+            interleave.export_changed_audio_chunks(chunks, tmpdir, "chapter-1", "EN", "ES")
+            self.assertEqual(len(encoded), 6)
+
+            # running again with the same plan doesn't touch anything
+            del encoded[:]
+            interleave.export_changed_audio_chunks(chunks, tmpdir, "chapter-1", "EN", "ES")
+            self.assertEqual((encoded, retagged), ([], []))
+
+            # a new chunk in the middle: only it is encoded, the chunks after it move along a track number
+            new_chunk = interleave.LangChunk(make_bursts([(100, 8000)], seed=99), "English", src_idx=9)
+            interleave.export_changed_audio_chunks(chunks[:2] + [new_chunk] + chunks[2:5], tmpdir,
+                                                   "chapter-1", "EN", "ES")
+            self.assertEqual(encoded, ["3-English-9.mp3"])
+            self.assertEqual(retagged, ["4-Spanish-2.mp3", "5-English-3.mp3", "6-Spanish-4.mp3"])
+            self.assertEqual(sorted(name for name in os.listdir(tmpdir) if name.endswith(".mp3")),
+                             ["1-Spanish-0.mp3", "2-English-1.mp3", "3-English-9.mp3", "4-Spanish-2.mp3",
+                              "5-English-3.mp3", "6-Spanish-4.mp3"])
+            with open(os.path.join(tmpdir, "5-English-3.mp3")) as f:
+                output = json.load(f)
+            self.assertEqual((output["track"], output["content"]), ("5", interleave.chunk_content_key(chunks[3])))
+
+            # re-encoding everything records what went into each file, so the next run keeps only what matches
+            del encoded[:]
+            reordered = chunks[::-1]
+            interleave.export_each_audio_chunk(reordered, tmpdir, "chapter-1", "EN", "ES")
+            del encoded[:], retagged[:]
+            open(os.path.join(tmpdir, ".reuse-0.mp3"), "w").close()
+            interleave.export_changed_audio_chunks(chunks, tmpdir, "chapter-1", "EN", "ES")
+            self.assertEqual(encoded, [])
+            for i, chunk in enumerate(chunks, start=1):
+                with open(os.path.join(tmpdir, "{}-{}-{}.mp3".format(i, chunk.lang_title, chunk.src_idx))) as f:
+                    self.assertEqual(json.load(f)["content"], interleave.chunk_content_key(chunk))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, ".reuse-0.mp3")))
+
+class SilenceDetectionTests(unittest.TestCase):
+    def test_split_matches_pydub(self):
+        audio = uneven_levels()
+        env = envelope.LoudnessEnvelope.from_segment(audio)
+        for silence_thresh in (-60, -46, -37, -30, -20, -10):
+            for min_silence_len, keep_silence in ((900, 900), (300, 100), (500, True)):
+                expected = pydub_split_on_silence(audio, min_silence_len=min_silence_len,
+                                                  silence_thresh=silence_thresh, keep_silence=keep_silence)
+                actual = envelope.split_on_silence(audio, min_silence_len=min_silence_len,
+                                                   silence_thresh=silence_thresh, keep_silence=keep_silence,
+                                                   envelope=env)
+                self.assertEqual([c.raw_data for c in actual], [c.raw_data for c in expected],
+                                 "thresh {} len {} keep {}".format(silence_thresh, min_silence_len, keep_silence))
+
+    def test_streaming_split_matches_whole_audio_split(self):
+        audio = uneven_levels()
+        samples = envelope.samples_of(audio)
+        for silence_thresh in (-60, -37, -20):
+            for min_silence_len, keep_silence in ((900, 900), (300, 100), (200, 0)):
+                expected = envelope.split_on_silence(audio, min_silence_len=min_silence_len,
+                                                     silence_thresh=silence_thresh, keep_silence=keep_silence)
+                splitter = StreamingSplitter(audio.frame_rate, audio.channels, min_silence_len=min_silence_len,
+                                             silence_thresh=silence_thresh, keep_silence=keep_silence)
+                actual = []
+                # odd block size, so block boundaries land all over the place
+                for start in range(0, len(samples), 2 * 1777):
+                    actual += splitter.feed(samples[start:start + 2 * 1777])
+                actual += splitter.finish()
+                self.assertEqual([c.raw_data for c in actual], [c.raw_data for c in expected])
+
+    def test_streaming_split_keeps_little_of_a_long_silence(self):
+        splitter = StreamingSplitter(8000, 1, min_silence_len=900, silence_thresh=-37, keep_silence=900)
+        chunks = splitter.feed(envelope.samples_of(make_bursts([(500, 0), (2000, 8000)], frame_rate=8000)))
+        silence = np.zeros(8000, dtype=np.int16)
+        sizes = []
+        for _ in range(600):
+            chunks += splitter.feed(silence)
+            sizes.append(len(splitter._buffer))
+        chunks += splitter.finish()
+        self.assertEqual(len(chunks), 1)
+        # once the chunk before it is out, no more of a ten minute silence is kept than could end up in the next one
+        self.assertLess(max(sizes[10:]), 8000 * 3)
+
+    def test_streamed_chunks_are_written_as_they_are_split(self):
+        audio = three_utterances()
+        samples = envelope.samples_of(audio)
+        blocks = [samples[start:start + 5000] for start in range(0, len(samples), 5000)]
+        expected = envelope.split_on_silence(audio, min_silence_len=900, silence_thresh=-37, keep_silence=900)
+        with tempfile.TemporaryDirectory() as chunkdir, \
+                mock.patch.object(interleave, "probe_audio", return_value=(audio.frame_rate, audio.channels)), \
+                mock.patch.object(interleave, "stream_pcm", return_value=iter(blocks)):
+            os.makedirs(os.path.join(chunkdir, "EN"))
+            chunks = interleave.chunk_track("audio.mp3", "English", "EN", "chapter-1", chunkdir, -37, 1,
+                                            streaming=True)
+            self.assertTrue(os.path.exists(os.path.join(chunkdir, "EN", "chapter-1.json")))
+            self.assertEqual([c.src_idx for c in chunks], [0, 1])
+            self.assertEqual([c.segment.raw_data for c in chunks], [c.raw_data for c in expected[1:]])
+        with self.assertRaises(ValueError):
+            interleave.chunk_track("audio.mp3", "English", "EN", "chapter-1", None, -37, 0, streaming=True)
+
+    def test_streaming_without_a_chunkdir_cleans_up_after_itself(self):
+        audio = three_utterances()
+        samples = envelope.samples_of(audio)
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(interleave, "probe_audio", return_value=(audio.frame_rate, audio.channels)), \
+                mock.patch.object(interleave, "stream_pcm", side_effect=lambda *args, **kwargs: iter([samples])), \
+                mock.patch.object(tempfile, "tempdir", tmpdir), mock.patch("builtins.print"):
+            chunks = interleave.interleave_chapter("en.mp3", "es.mp3", "chapter-1", os.path.join(tmpdir, "out"),
+                                                   streaming=True, dry_run=True)
+            self.assertEqual(len(chunks), 6)
+            self.assertEqual([name for name in os.listdir(tmpdir) if name.startswith("interleave-chunks-")], [])
+
+    def test_failed_decode_is_reported(self):
+        with mock.patch.object(AudioSegment, "converter", "false"):
+            with self.assertRaises(CouldntDecodeError):
+                list(stream_pcm("audio.mp3", 8000, 1))
+
+    def test_threshold_index_matches_split(self):
+        audio = uneven_levels()
+        env = envelope.LoudnessEnvelope.from_segment(audio)
+        for min_silence_len, keep_silence in ((900, 900), (300, 100), (200, 0)):
+            index = envelope.ThresholdIndex(env, min_silence_len=min_silence_len, keep_silence=keep_silence)
+            for silence_thresh in range(-70, 1, 2):
+                ranges = env.split_ranges(min_silence_len, silence_thresh, keep_silence)
+                self.assertEqual(index.chunk_count(silence_thresh), len(ranges))
+                self.assertAlmostEqual(index.total_duration(silence_thresh),
+                                       sum(end - start for start, end in ranges) / 1000.0)
+
+    def test_chunk_boundaries_follow_the_speech(self):
+        audio, bursts = synthetic_track(120, seed=1)
+        env = envelope.LoudnessEnvelope.from_segment(audio)
+        nonsilent = env.detect_nonsilent(min_silence_len=900, silence_thresh=-37)
+        self.assertEqual(len(nonsilent), len(bursts))
+        # a window only sounds loud once it overlaps a burst by a few ms
+        for (start, end), (burst_start, burst_end) in zip(nonsilent, bursts):
+            self.assertLessEqual(abs(start - burst_start), 10)
+            self.assertLessEqual(abs(end - burst_end), 10)
+
+        chunks = interleave.create_audio_chunks(audio, 5, 15, "English", threshold_search="index")
+        self.assertEqual(len(chunks), len(bursts))
+        for chunk, (burst_start, burst_end) in zip(chunks, bursts):
+            self.assertGreater(chunk.duration_seconds * 1000, burst_end - burst_start)
+
+    def test_create_audio_chunks(self):
+        audio = three_utterances()
+        chunks = interleave.create_audio_chunks(audio, 5, 15, "English")
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual([c.src_idx for c in chunks], [0, 1, 2])
+
+    def test_create_audio_chunks_with_index_search(self):
+        audio = three_utterances()
+        chunks = interleave.create_audio_chunks(audio, 5, 15, "English", initial_silence_thresh=-10,
+                                                threshold_search="index")
+        self.assertEqual(len(chunks), 3)
+        # the threshold is reported on the chunks so that the same split can be reproduced
+        silence_thresh = chunks[0].silence_thresh
+        again = interleave.create_audio_chunks(audio, 5, 15, "English", initial_silence_thresh=silence_thresh)
+        self.assertEqual([c.segment.raw_data for c in again], [c.segment.raw_data for c in chunks])
+
+
+class AudioCacheTests(unittest.TestCase):
+    def test_decoded_audio_is_reused_and_evicted(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(2):
+                path = os.path.join(tmpdir, "chapter-{}.wav".format(i))
+                make_bursts([(500, 0), (2000, 8000), (500, 0)], seed=i).export(path, format="wav")
+                paths.append(path)
+
+            cache = AudioCache(os.path.join(tmpdir, "cache"))
+            audio, env = cache.load(paths[0], format="wav")
+            cached_audio, cached_env = cache.load(paths[0], format="wav")
+            self.assertEqual(cached_audio.raw_data, audio.raw_data)
+            self.assertEqual(cached_audio.frame_rate, audio.frame_rate)
+            np.testing.assert_array_equal(cached_env.window_rms(900), env.window_rms(900))
+
+            # only room for one entry, the least recently used one goes
+            entry_size = sum(os.path.getsize(os.path.join(cache.cache_dir, name)) for name in os.listdir(cache.cache_dir))
+            cache.max_bytes = entry_size
+            cache.load(paths[1], format="wav")
+            keys = {name.split(".")[0] for name in os.listdir(cache.cache_dir)}
+            self.assertEqual(keys, {cache.key(paths[1], format="wav")})
+
+
+    def test_processes_can_share_a_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(4):
+                path = os.path.join(tmpdir, "chapter-{}.wav".format(i))
+                make_bursts([(500, 0), (1000, 8000), (500, 0)], seed=i).export(path, format="wav")
+                paths.append(path)
+            # room for about two entries, so the processes keep evicting what the others are reading
+            cache_dir = os.path.join(tmpdir, "cache")
+            with ProcessPoolExecutor(max_workers=4) as executor:
+                lengths = list(executor.map(_load_from_shared_cache,
+                                            [(cache_dir, paths, worker) for worker in range(4)]))
+            self.assertEqual(lengths, [[2000] * 40] * 4)
+
+
+class ChunkStoreTests(unittest.TestCase):
+    def test_dry_run_from_saved_chunks_needs_no_outdir(self):
+        audio = three_utterances()
+        chunks = interleave.create_audio_chunks(audio, 5, 15, "English")
+        with tempfile.TemporaryDirectory() as chunkdir:
+            for lang_code in ("EN", "ES"):
+                os.makedirs(os.path.join(chunkdir, lang_code))
+                interleave.export_raw_audio_chunks(chunks, chunkdir, "chapter-1", lang_code)
+            with mock.patch("builtins.print") as print_:
+                planned = interleave.interleave_chapter(None, None, "chapter-1", None, chunkdir=chunkdir,
+                                                        dry_run=True)
+            self.assertEqual(len(planned), 6)
+            self.assertEqual(print_.call_args[0][0], "ES:0 EN:0 ES:1 EN:1 ES:2 EN:2")
+
+    def test_raw_chunks_round_trip(self):
+        audio = three_utterances()
+        chunks = interleave.create_audio_chunks(audio, 5, 15, "Spanish", discard_initial_chunks=1)
+        with tempfile.TemporaryDirectory() as chunkdir:
+            os.makedirs(os.path.join(chunkdir, "ES"))
+            interleave.export_raw_audio_chunks(chunks, chunkdir, "chapter-1", "ES")
+            loaded = interleave.load_audio_chunks(os.path.join(chunkdir, "ES"), "chapter-1", "Spanish")
+            self.assertEqual([c.src_idx for c in loaded], [c.src_idx for c in chunks])
+            self.assertEqual([c.silence_thresh for c in loaded], [c.silence_thresh for c in chunks])
+            self.assertEqual([c.duration_seconds for c in loaded], [c.duration_seconds for c in chunks])
+            self.assertEqual([c.segment.raw_data for c in loaded], [c.segment.raw_data for c in chunks])
+
+
+    def test_rewriting_a_store_replaces_it_whole(self):
+        first = [make_bursts([(500, 8000)], seed=1), make_bursts([(700, 8000)], seed=2)]
+        second = [make_bursts([(300, 8000)], seed=3)]
+        with tempfile.TemporaryDirectory() as store_dir:
+            chunk_store.save_chunk_store(first, store_dir, "chapter-1")
+            # a failed write leaves the store that was there alone
+            with self.assertRaises(RuntimeError):
+                with chunk_store.ChunkStoreWriter(store_dir, "chapter-1") as writer:
+                    writer.add(second[0], 0)
+                    raise RuntimeError("interrupted")
+            store = chunk_store.ChunkStore(store_dir, "chapter-1")
+            self.assertEqual([store.segment(i).raw_data for i in range(len(store))], [s.raw_data for s in first])
+
+            chunk_store.save_chunk_store(second, store_dir, "chapter-1")
+            store = chunk_store.ChunkStore(store_dir, "chapter-1")
+            self.assertEqual([store.segment(i).raw_data for i in range(len(store))], [s.raw_data for s in second])
+            self.assertEqual(sorted(os.listdir(store_dir)), ["chapter-1.json", "chapter-1.pcm"])
+
+
+class InstrumentationTests(unittest.TestCase):
+    def test_stages_and_counters_are_recorded(self):
+        audio = three_utterances()
+        # worker processes send their profile back to be merged with the main process's
+        chunks, profile = instrumentation.run_profiled(interleave.create_audio_chunks, audio, 5, 15, "English")
+        self.assertEqual(len(chunks), 3)
+        self.assertGreaterEqual(profile["counters"]["threshold_search_attempts"], 1)
+
+        main_profile = instrumentation.Profile()
+        with main_profile.stage("plan"):
+            main_profile.count("threshold_search_attempts")
+        main_profile.merge(profile)
+        main_profile.merge(profile)
+        stages = main_profile.to_dict()["stages"]
+        self.assertEqual(stages["plan"]["calls"], 1)
+        self.assertGreaterEqual(stages["plan"]["wall_seconds"], 0)
+        self.assertEqual(main_profile.counters["threshold_search_attempts"],
+                         1 + 2 * profile["counters"]["threshold_search_attempts"])
+
+
+class TranscriptionTests(unittest.TestCase):
+    def test_chunks_are_transcribed_concurrently_and_cached(self):
+        audio = three_utterances()
+        chunks = interleave.create_audio_chunks(audio, 5, 15, "Spanish")
+
+        class CountingRecognizer(split_and_synchronize.FakeRecognizer):
+            in_flight = max_in_flight = 0
+
+            async def recognize(self, segment, language_code):
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    return await super().recognize(segment, language_code)
+                finally:
+                    self.in_flight -= 1
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = split_and_synchronize.TranscriptCache(tmpdir)
+            recognizer = CountingRecognizer(delay_seconds=0.01)
+            transcriptions = split_and_synchronize.transcribe_chunks(chunks, recognizer, "es-MX", cache=cache,
+                                                                     concurrency=2)
+            self.assertEqual(recognizer.calls, 3)
+            self.assertEqual(recognizer.max_in_flight, 2)
+            for chunk, transcription in zip(chunks, transcriptions):
+                self.assertEqual(len(transcription["words"]), 1)
+                word = transcription["words"][0]
+                self.assertLess(word["start_seconds"], word["end_seconds"])
+                self.assertLessEqual(word["end_seconds"], chunk.duration_seconds)
+
+            # nothing is transcribed a second time
+            again = CountingRecognizer()
+            self.assertEqual(split_and_synchronize.transcribe_chunks(chunks, again, "es-MX", cache=cache),
+                             transcriptions)
+            self.assertEqual(again.calls, 0)
+
+
+    def test_long_chunks_are_sent_to_google_in_pieces(self):
+        with self.assertRaises(TypeError):
+            split_and_synchronize.Recognizer()
+        # no client is made, the pieces go to a stand in for the request
+        recognizer = split_and_synchronize.GoogleRecognizer.__new__(split_and_synchronize.GoogleRecognizer)
+        pieces = []
+
+        def recognize_piece(segment, language_code):
+            pieces.append(len(segment))
+            return {"transcript": "piece", "words": [{"word": "piece", "start_seconds": 1.0, "end_seconds": 2.0}]}
+
+        with mock.patch.object(recognizer, "_recognize_piece", recognize_piece):
+            transcription = recognizer._recognize(make_bursts([(130000, 8000)], channels=1), "es-MX")
+        self.assertEqual(pieces, [55000, 55000, 20000])
+        self.assertEqual(transcription["transcript"], "piece piece piece")
+        self.assertEqual([word["start_seconds"] for word in transcription["words"]], [1.0, 56.0, 111.0])
+
+
+class ConvertAudioTests(unittest.TestCase):
+    def test_only_out_of_date_files_are_converted(self):
+        converted = []
+
+        def fake_convert_file(path, out_path, settings):
+            converted.append(os.path.basename(path))
+            with open(out_path, "w") as f:
+                f.write(settings["format"])
+
+        with mock.patch.object(convert_audio, "convert_file", fake_convert_file), \
+                tempfile.TemporaryDirectory() as tmpdir:
+            indir = os.path.join(tmpdir, "in")
+            os.makedirs(os.path.join(indir, "book-2"))
+            for name in ["book-1.mp3", "book-2/chapter-1.mp3", "book-2/chapter-2.MP3", "notes.txt"]:
+                with open(os.path.join(indir, name), "w") as f:
+                    f.write(name)
+            # a directory and a glob matching some of the same files
+            inputs = convert_audio.find_inputs([indir, os.path.join(indir, "*.mp3")])
+            self.assertEqual([os.path.relpath(path, root) for path, root in inputs],
+                             ["book-1.mp3", os.path.join("book-2", "chapter-1.mp3"),
+                              os.path.join("book-2", "chapter-2.MP3")])
+
+            outdir = os.path.join(tmpdir, "out")
+            self.assertEqual(convert_audio.convert_all(inputs, outdir, check="hash"), [])
+            self.assertEqual(len(converted), 3)
+            self.assertTrue(os.path.exists(os.path.join(outdir, "book-2", "chapter-2.flac")))
+
+            # touched but not changed: only redone when checking modification times
+            del converted[:]
+            os.utime(os.path.join(indir, "book-1.mp3"), (time.time() + 10, time.time() + 10))
+            convert_audio.convert_all(inputs, outdir, check="hash")
+            self.assertEqual(converted, [])
+            convert_audio.convert_all(inputs, outdir, check="mtime")
+            self.assertEqual(converted, ["book-1.mp3"])
+
+            # different settings make a different output
+            del converted[:]
+            convert_audio.convert_all(inputs, outdir, settings={"format": "flac", "frame_rate": 16000},
+                                      check="hash")
+            self.assertEqual(len(converted), 3)
+
+            # files with the same name found by different globs would overwrite each other
+            with open(os.path.join(indir, "book-2", "book-1.mp3"), "w") as f:
+                f.write("book-1")
+            collisions = convert_audio.find_inputs([os.path.join(indir, "*.mp3"), os.path.join(indir, "*", "*.mp3")])
+            with self.assertRaisesRegex(ValueError, "book-1.flac"):
+                convert_audio.convert_all(collisions, outdir, force=True)
+
+
+    def test_ffmpeg_is_kept_off_the_terminal(self):
+        def fake_run(command, **kwargs):
+            with open(command[-1], "w") as f:
+                f.write("flac")
+            return mock.Mock(returncode=0)
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(convert_audio.subprocess, "run", side_effect=fake_run) as run:
+            convert_audio.convert_file("book.mp3", os.path.join(tmpdir, "book.flac"), {"format": "flac"})
+        self.assertIs(run.call_args[1]["stdin"], convert_audio.subprocess.DEVNULL)
+
+
+class ChapterSplittingTests(unittest.TestCase):
+    def test_boundaries_from_cue_and_json(self):
+        cue = "FILE \"book.mp3\" MP3\n  TRACK 01 AUDIO\n    INDEX 01 00:00:00\n  TRACK 02 AUDIO\n" \
+              "    TITLE \"Chapter 2\"\n    INDEX 01 03:08:45\n"
+        self.assertEqual(split_into_chapters.parse_cue(cue), [(0, 188.6), (188.6, None)])
+        self.assertEqual(split_into_chapters.parse_boundaries_json([{"start": 0}, {"start": 188, "end": 300}]),
+                         [(0, 188), (188, 300)])
+
+    def test_detect_chapters_at_long_silences(self):
+        speech = [(700, 8000), (300, 0)] * 5
+        audio = make_bursts(speech + [(3000, 0)] + speech * 2 + [(2500, 0)] + speech + [(1500, 0)] + speech)
+        envelope_ = envelope.LoudnessEnvelope.from_segment(audio)
+        chapters = split_into_chapters.detect_chapters(envelope_, min_silence_len=1000, silence_thresh=-40,
+                                                       min_chapter_len=4)
+        # cut in the middle of each silence, the first is 4.7 - 8.0 sec
+        for (start, _), expected in zip(chapters, [0, 6.35, 19.1, 26.1]):
+            self.assertAlmostEqual(start, expected, delta=0.1)
+        self.assertEqual(len(chapters), 4)
+        self.assertIsNone(chapters[-1][1])
+        # only the longest silences when the number of chapters is known
+        chapters = split_into_chapters.detect_chapters(envelope_, min_silence_len=1000, silence_thresh=-40,
+                                                       min_chapter_len=4, chapter_count=2)
+        self.assertEqual(len(chapters), 2)
+        self.assertAlmostEqual(chapters[1][0], 6.35, delta=0.1)
+
+    def test_envelope_is_measured_as_the_audio_is_decoded(self):
+        audio = uneven_levels(channels=1)
+        samples = envelope.samples_of(audio)
+        # blocks that end part way through a millisecond
+        blocks = [samples[start:start + 1777] for start in range(0, len(samples), 1777)]
+        with mock.patch.object(split_into_chapters, "stream_pcm", return_value=iter(blocks)):
+            streamed = split_into_chapters.measure_envelope("book.mp3", frame_rate=audio.frame_rate)
+        whole = envelope.LoudnessEnvelope.from_segment(audio)
+        self.assertEqual(streamed.length_ms, whole.length_ms)
+        np.testing.assert_array_equal(streamed.cumulative_energy, whole.cumulative_energy)
+
+    def test_split_copies_in_one_pass_and_falls_back_to_encoding(self):
+        chapters = [(0, 188), (188, 300), (300, None)]
+        files = split_into_chapters.chapter_files(chapters, "out", "mp3", "The Little Prince", "bv", "tlp-ch")
+        commands = []
+
+        def fake_run_ffmpeg(command):
+            commands.append(command)
+            if "copy" in command and fail_copy:
+                raise RuntimeError("can't copy")
+
+        with mock.patch.object(split_into_chapters, "_run_ffmpeg", fake_run_ffmpeg), \
+                mock.patch.object(split_into_chapters, "can_copy", return_value=True):
+            fail_copy = False
+            self.assertEqual(split_into_chapters.split_chapters("book.mp3", chapters, files), "copy")
+            self.assertEqual(len(commands), 1)
+            self.assertEqual(commands[0].count("-i"), 1)
+            self.assertEqual([commands[0].index(path) for path, _ in files], sorted(commands[0].index(path)
+                                                                                   for path, _ in files))
+            fail_copy = True
+            del commands[:]
+            self.assertEqual(split_into_chapters.split_chapters("book.mp3", chapters, files, jobs=2), "encode")
+            self.assertEqual(len(commands), 4)
+            self.assertEqual(sorted(command[-1] for command in commands[1:]), [path for path, _ in files])
+
+
+class ServiceTests(unittest.TestCase):
+    def test_jobs_reuse_resident_tracks_and_stream_progress(self):
+        decoded = []
+
+        def fake_decode_audio(path, cache=None):
+            decoded.append(path)
+            track, _ = synthetic_track(60, seed=len(path), stretch=1.2 if "es" in path else 1.0)
+            return track, None
+
+        with mock.patch.object(interleave, "decode_audio", fake_decode_audio), \
+                tempfile.TemporaryDirectory() as tmpdir:
+            service = interleave_service.InterleaveService(workers=2)
+            server = interleave_service.make_server(service, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                paths = {}
+                for name in ["en.mp3", "es.mp3"]:
+                    paths[name] = os.path.join(tmpdir, name)
+                    open(paths[name], "w").close()
+                url = "http://127.0.0.1:{}".format(server.server_address[1])
+                job = {"base_audio": paths["en.mp3"], "target_audio": paths["es.mp3"], "title": "chapter-1",
+                       "outdir": os.path.join(tmpdir, "out"), "threshold_search": "index", "dry_run": True}
+
+                def post(body):
+                    request = urllib.request.Request(url + "/jobs", data=json.dumps(body).encode(), method="POST")
+                    with urllib.request.urlopen(request) as response:
+                        return json.load(response)
+
+                # the events stream ends once the job is finished, with its final status
+                first = post(job)
+                with urllib.request.urlopen("{}/jobs/{}/events".format(url, first["id"])) as response:
+                    events = [json.loads(line) for line in response]
+                self.assertEqual(events[-1]["status"], "done")
+                self.assertIn("Done", [event.get("message") for event in events])
+                plan = events[-1]["result"]["plan"]
+
+                # a sync point tweak is planned from the chunks already in memory
+                second = post(dict(job, sync_points=["3:3"]))
+                with urllib.request.urlopen("{}/jobs/{}/events".format(url, second["id"])) as response:
+                    events = [json.loads(line) for line in response]
+                self.assertEqual(events[-1]["status"], "done")
+                self.assertEqual([event["cached"] for event in events if "cached" in event], [True, True])
+                self.assertEqual(sorted(decoded), sorted(paths.values()))
+                self.assertEqual(len(events[-1]["result"]["plan"]), len(plan))
+
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    post({"base_audio": paths["en.mp3"]})
+                self.assertEqual(e.exception.code, 400)
+                # a body that isn't a JSON object is refused too
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    post(["not", "a", "job"])
+                self.assertEqual(e.exception.code, 400)
+            finally:
+                server.shutdown()
+                server.server_close()
+                service.close()
+
+    def test_resident_entries_are_made_once_and_key_locks_let_go(self):
+        cache = interleave_service.ResidentCache(max_bytes=10)
+        made = []
+
+        def create():
+            made.append(1)
+            time.sleep(0.05)
+            return "value"
+
+        threads = [threading.Thread(target=cache.get, args=(("track", "a"), create, lambda value: 8))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(made), 1)
+        # a second entry pushes the first out, neither leaves a lock behind
+        self.assertEqual(cache.get(("track", "b"), lambda: "other", lambda value: 8), ("other", False))
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.assertEqual(cache._key_locks, {})
+
+
+class BatchTests(unittest.TestCase):
+    def test_manifest_defaults_and_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest_path = os.path.join(tmpdir, "book.json")
+            with open(manifest_path, "w") as f:
+                json.dump({"outdir": "out", "target_offset": 1, "chapters": [
+                    {"title": "chapter-1", "base_audio": "en-1.mp3", "target_audio": "es-1.mp3"},
+                    {"title": "chapter-2", "base_audio": "en-2.mp3", "target_audio": "es-2.mp3",
+                     "target_offset": 0, "outdir": "elsewhere"},
+                ]}, f)
+            chapters = batch_interleave.load_manifest(manifest_path)
+            self.assertEqual([c["outdir"] for c in chapters], ["out/chapter-1", "elsewhere"])
+            self.assertEqual([c["target_offset"] for c in chapters], [1, 0])
+
+            # chapters finished with the same settings are skipped, without starting any work
+            progress_path = os.path.join(tmpdir, "progress.json")
+            batch_interleave.save_progress(progress_path, {c["title"]: {"chapter": c} for c in chapters})
+            self.assertEqual(batch_interleave.run_batch(chapters, progress_path, workers=1), [])
+
+    def test_chapters_run_and_failures_are_retried(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = {}
+            for name in ["en-1.wav", "es-1.wav", "en-2.wav"]:
+                paths[name] = os.path.join(tmpdir, name)
+                synthetic_track(30, seed=len(paths))[0].export(paths[name], format="wav")
+            # es-2.wav isn't there yet, so chapter-2 fails
+            paths["es-2.wav"] = os.path.join(tmpdir, "es-2.wav")
+            chapters = [{"title": "chapter-{}".format(i), "base_audio": paths["en-{}.wav".format(i)],
+                         "target_audio": paths["es-{}.wav".format(i)], "outdir": os.path.join(tmpdir, "out"),
+                         "threshold_search": "index", "dry_run": True} for i in (1, 2)]
+            progress_path = os.path.join(tmpdir, "progress.json")
+            # worker processes are forked, so they see the patches as well
+            with mock.patch.object(interleave, "decode_audio", lambda path, cache=None: (AudioSegment.from_wav(path), None)), \
+                    mock.patch("builtins.print"):
+                self.assertEqual(batch_interleave.run_batch(chapters, progress_path, workers=2), ["chapter-2"])
+                progress = batch_interleave.load_progress(progress_path)
+                self.assertEqual(list(progress), ["chapter-1"])
+                self.assertEqual(progress["chapter-1"]["chapter"], chapters[0])
+                self.assertGreater(progress["chapter-1"]["audio_seconds"], 0)
+
+                # a rerun only does the chapter that failed
+                synthetic_track(30, seed=4)[0].export(paths["es-2.wav"], format="wav")
+                self.assertEqual(batch_interleave.run_batch(chapters, progress_path, workers=2), [])
+                rerun = batch_interleave.load_progress(progress_path)
+                self.assertEqual(sorted(rerun), ["chapter-1", "chapter-2"])
+                self.assertEqual(rerun["chapter-1"], progress["chapter-1"])
+
+
 if __name__ == '__main__':
     unittest.main()